@@ -0,0 +1,45 @@
+"""Measure how the naming of environments in _all_envs scales.
+
+Every environment is named `dev` in its own project, so they all collide
+and need to be disambiguated with a counter.
+
+Usage: python benchmarks/bench_all_envs.py [ENV_COUNT ...]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+from nb_conda_kernels.manager import CondaKernelSpecManager
+
+REPEAT = 5
+
+
+def run(env_count):
+    root = os.path.abspath(os.path.join(os.sep, 'nonexistent', 'conda'))
+    envs = [os.path.join(root, 'projects', str(count), 'proj', 'envs', 'dev')
+            for count in range(env_count)]
+    conda_info = {'conda_prefix': root, 'envs': envs,
+                  'envs_dirs': [os.path.join(root, 'envs')]}
+
+    class Manager(CondaKernelSpecManager):
+        _conda_info = conda_info
+
+        def _all_kernels(self, envs=None):
+            return {}
+
+    manager = Manager()
+    assert len(manager._all_envs()) == env_count + 1
+    return min(timeit.repeat(manager._all_envs, number=1, repeat=REPEAT))
+
+
+def main(counts):
+    print('{:>8} {:>12} {:>14}'.format('envs', 'total (ms)', 'per env (us)'))
+    for count in counts:
+        elapsed = run(count)
+        print('{:>8} {:>12.2f} {:>14.2f}'.format(count, elapsed * 1000, elapsed * 1e6 / count))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000])
@@ -0,0 +1,70 @@
+"""Measure the memory held by the conda kernel cache, per 1,000 kernels.
+
+The compact cache is measured once every kernel spec has been loaded,
+which is its largest size. It is compared with the previous form of the
+cache, a full KernelSpec with its own metadata dict per kernel.
+
+Usage: python benchmarks/bench_cache_memory.py [ENV_COUNT [KERNELS_PER_ENV]]
+"""
+from __future__ import print_function
+
+import gc
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+from jupyter_client.kernelspec import KernelSpec
+
+from nb_conda_kernels.manager import CondaKernelSpecManager
+
+from synthetic import make_installation
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        cache = build()
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return cache, after - before
+
+
+def main(env_count, kernels_per_env):
+    root = tempfile.mkdtemp()
+    try:
+        conda_info, _ = make_installation(root, env_count, kernels_per_env)
+
+        class Manager(CondaKernelSpecManager):
+            _conda_info = conda_info
+
+        manager = Manager(conda_only=True)
+
+        def compact():
+            kernels = manager._all_kernels()
+            for kernel in kernels.values():
+                manager._load_kernel(kernel)
+            return kernels
+
+        def kernel_specs():
+            return {name: KernelSpec(**spec) for name, spec in manager._all_specs().items()}
+
+        kernels, compact_size = measure(compact)
+        specs, spec_size = measure(kernel_specs)
+        count = len(kernels)
+        assert count == len(specs) == env_count * kernels_per_env
+        print('{} kernels in {} environments'.format(count, env_count))
+        print('{:>12} {:>16}'.format('cache', 'KiB/1000 kernels'))
+        for label, size in (('KernelSpec', spec_size), ('compact', compact_size)):
+            print('{:>12} {:>16.1f}'.format(label, size * 1000.0 / count / 1024))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [1000, 1][len(args):]))
@@ -0,0 +1,119 @@
+"""Compare get_all_specs against the previous two-pass implementation.
+
+The previous implementation, copied below from nb_conda_kernels 2.3.2,
+built the find_kernel_specs dict, walking the standard kernel directories
+and canonicalizing each of them with three stats, and then called
+get_kernel_spec for every name: the conda kernels came from a cache of
+full KernelSpec objects, while each standard kernel was searched for in
+the kernel directories and its kernel.json read again by the superclass.
+
+Usage: python benchmarks/bench_get_all_specs.py [CONDA_KERNEL_COUNT ...]
+
+Each installation also carries NATIVE_KERNELS standard Jupyter kernels.
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from jupyter_client.kernelspec import KernelSpec, KernelSpecManager, NoSuchKernel
+
+from nb_conda_kernels.manager import CondaKernelSpecManager
+
+from synthetic import make_installation
+
+REPEAT = 20
+NATIVE_KERNELS = 100
+
+_canonical_paths = {}
+
+
+def previous_canonicalize(path):
+    def _inode(p):
+        try:
+            return os.stat(p).st_ino
+        except FileNotFoundError:
+            return -1
+    inode1 = _inode(path)
+    plower = path.lower()
+    inode2 = _inode(plower)
+    if inode1 != inode2:
+        return path
+    inode3 = _inode(path.upper())
+    if inode3 != inode2:
+        return path
+    return _canonical_paths.setdefault(plower, path)
+
+
+class PreviousManager(object):
+    """The listing methods of nb_conda_kernels 2.3.2, on top of its cache
+    of conda KernelSpecs, which is built once and reused, as it was until
+    its expiry."""
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.conda_only = manager.conda_only
+        self.conda_kspecs = {name: KernelSpec(**info) for name, info in manager._all_specs().items()}
+
+    def find_kernel_specs(self):
+        if self.conda_only:
+            kspecs = {}
+        else:
+            kspecs = KernelSpecManager.find_kernel_specs(self.manager)
+            kspecs = {k: previous_canonicalize(v) for k, v in kspecs.items()}
+        spec_rev = {v: k for k, v in kspecs.items()}
+        for name, spec in self.conda_kspecs.items():
+            kspecs[name] = spec.resource_dir
+            dup = spec_rev.get(kspecs[name])
+            if dup:
+                del kspecs[dup]
+        return kspecs
+
+    def get_kernel_spec(self, kernel_name):
+        res = self.conda_kspecs.get(kernel_name)
+        if res is None and not self.conda_only:
+            res = KernelSpecManager.get_kernel_spec(self.manager, kernel_name)
+        return res
+
+    def get_all_specs(self):
+        res = {}
+        for name, resource_dir in self.find_kernel_specs().items():
+            try:
+                spec = self.get_kernel_spec(name)
+                res[name] = {'resource_dir': resource_dir, 'spec': spec.to_dict()}
+            except NoSuchKernel:
+                pass
+        return res
+
+
+def run(kernel_count):
+    root = tempfile.mkdtemp()
+    try:
+        conda_info, native_dir = make_installation(root, kernel_count, native_count=NATIVE_KERNELS)
+
+        class Manager(CondaKernelSpecManager):
+            _conda_info = conda_info
+
+        manager = Manager(kernel_dirs=[native_dir], ensure_native_kernel=False)
+        previous = PreviousManager(manager)
+        assert previous.get_all_specs() == manager.get_all_specs()
+        two_pass = min(timeit.repeat(previous.get_all_specs, number=1, repeat=REPEAT))
+        single_pass = min(timeit.repeat(manager.get_all_specs, number=1, repeat=REPEAT))
+        return two_pass, single_pass
+    finally:
+        shutil.rmtree(root)
+
+
+def main(counts):
+    print('{:>8} {:>14} {:>14} {:>8}'.format('kernels', 'two-pass (ms)', 'single (ms)', 'speedup'))
+    for count in counts:
+        two_pass, single_pass = run(count)
+        print('{:>8} {:>14.2f} {:>14.2f} {:>7.1f}x'.format(
+            count + NATIVE_KERNELS, two_pass * 1000, single_pass * 1000, two_pass / single_pass))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 1000])
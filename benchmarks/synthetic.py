@@ -0,0 +1,56 @@
+"""Generate synthetic conda installations for the benchmarks."""
+import json
+import os
+import sys
+
+KERNEL_SPEC = {
+    'display_name': 'Python 3',
+    'language': 'python',
+    'argv': ['python', '-m', 'ipykernel_launcher', '-f', '{connection_file}'],
+    'metadata': {'debugger': True},
+}
+
+
+def write_kernel(kernel_dir, spec=KERNEL_SPEC):
+    os.makedirs(kernel_dir)
+    with open(os.path.join(kernel_dir, 'kernel.json'), 'w') as fp:
+        json.dump(spec, fp)
+
+
+def make_installation(root, env_count, kernels_per_env=1, native_count=0):
+    """Create a fake conda root under root with env_count environments
+    holding kernels_per_env kernels each, plus native_count standard
+    Jupyter kernels. Returns the matching subset of the `conda info --json`
+    output, and the standard kernel directory."""
+    envs = []
+    for env in range(env_count):
+        env_path = os.path.join(root, 'envs', 'env{}'.format(env))
+        for kernel in range(kernels_per_env):
+            write_kernel(os.path.join(env_path, 'share', 'jupyter', 'kernels',
+                                      'python3' if kernel == 0 else 'kernel{}'.format(kernel)))
+        envs.append(env_path)
+    native_dir = os.path.join(root, 'native')
+    os.makedirs(native_dir)
+    for kernel in range(native_count):
+        write_kernel(os.path.join(native_dir, 'native{}'.format(kernel)))
+    conda_info = {'conda_prefix': root, 'envs': envs,
+                  'envs_dirs': [os.path.join(root, 'envs')]}
+    return conda_info, native_dir
+
+
+def write_conda_stub(root, conda_info):
+    """Write a stub `conda` executable under root, which prints conda_info
+    for `conda info --json`, as CONDA_EXE for the manager. Returns its path."""
+    info_path = os.path.join(root, 'info.json')
+    with open(info_path, 'w') as fp:
+        json.dump(conda_info, fp)
+    if sys.platform.startswith('win'):
+        conda_exe = os.path.join(root, 'conda.bat')
+        script = '@type "{}"\n'.format(info_path)
+    else:
+        conda_exe = os.path.join(root, 'conda')
+        script = '#!/bin/sh\ncat "{}"\n'.format(info_path)
+    with open(conda_exe, 'w') as fp:
+        fp.write(script)
+    os.chmod(conda_exe, 0o755)
+    return conda_exe
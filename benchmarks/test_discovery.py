@@ -0,0 +1,96 @@
+"""Benchmark the kernel discovery against synthetic conda installations.
+
+Each installation has ENV_COUNT environments, with KERNELS_PER_ENV kernels
+each, and a stub `conda` executable which prints its `conda info --json`:
+nothing is downloaded, and no conda is needed.
+
+Requires pytest-benchmark. Timings depend on the machine, so compare runs
+on the same one: from the root of the repository, save a baseline from the
+commit to compare with,
+
+    pytest benchmarks --benchmark-save=baseline
+
+then, with the changes,
+
+    pytest benchmarks --benchmark-compare --benchmark-compare-fail=mean:25%
+
+fails if any benchmark is more than 25% slower than the last saved run,
+which pytest-benchmark keeps under .benchmarks.
+
+NB_CONDA_KERNELS_BENCH_SIZES restricts the environment counts, e.g. to
+`10,100` for a quick run.
+"""
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from nb_conda_kernels import manager as manager_module  # noqa
+from nb_conda_kernels.manager import CondaKernelSpecManager  # noqa
+
+from synthetic import make_installation, write_conda_stub  # noqa
+
+ENV_COUNTS = [int(count) for count in
+              os.environ.get("NB_CONDA_KERNELS_BENCH_SIZES", "10,100,1000,10000").split(",")]
+KERNELS_PER_ENV = 2
+NATIVE_KERNELS = 10
+ROUNDS = 5
+
+
+@pytest.fixture(scope="module", params=ENV_COUNTS, ids="{}envs".format)
+def installation(request, tmp_path_factory):
+    root = str(tmp_path_factory.mktemp("conda"))
+    conda_info, native_dir = make_installation(root, request.param, KERNELS_PER_ENV, NATIVE_KERNELS)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(manager_module, "CONDA_EXE", write_conda_stub(root, conda_info))
+        yield request.param, native_dir
+    shutil.rmtree(root)
+
+
+def new_manager(native_dir, **kwargs):
+    return CondaKernelSpecManager(kernel_dirs=[native_dir], ensure_native_kernel=False, **kwargs)
+
+
+def expire(manager):
+    # Only the conda kernels are rediscovered; conda info is still cached
+    manager._snapshot = manager._snapshot._replace(expiry=0)
+    return (manager,), {}
+
+
+def test_init(benchmark, installation):
+    env_count, native_dir = installation
+    manager = benchmark.pedantic(new_manager, args=(native_dir,), rounds=ROUNDS)
+    assert len(manager._conda_kspecs) == env_count * KERNELS_PER_ENV
+
+
+def test_find_kernel_specs(benchmark, installation):
+    env_count, native_dir = installation
+    manager = new_manager(native_dir)
+    specs = benchmark.pedantic(CondaKernelSpecManager.find_kernel_specs,
+                               setup=lambda: expire(manager), rounds=ROUNDS)
+    assert len(specs) == env_count * KERNELS_PER_ENV + NATIVE_KERNELS
+
+
+def test_get_all_specs(benchmark, installation):
+    env_count, native_dir = installation
+    manager = new_manager(native_dir)
+    specs = benchmark(manager.get_all_specs)
+    assert len(specs) == env_count * KERNELS_PER_ENV + NATIVE_KERNELS
+
+
+def test_get_kernel_spec(benchmark, installation):
+    env_count, native_dir = installation
+    manager = new_manager(native_dir)
+    name = sorted(manager._conda_kspecs)[-1]
+    spec = benchmark(manager.get_kernel_spec, name)
+    assert spec.argv
+
+
+def test_kernelspec_path_sync(benchmark, installation, tmp_path):
+    env_count, native_dir = installation
+    manager = new_manager(native_dir, kernelspec_path=str(tmp_path))
+    benchmark.pedantic(CondaKernelSpecManager.find_kernel_specs,
+                       setup=lambda: expire(manager), rounds=ROUNDS)
+    assert len(os.listdir(str(tmp_path / "share" / "jupyter" / "kernels"))) == env_count * KERNELS_PER_ENV
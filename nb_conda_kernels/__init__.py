@@ -2,3 +2,9 @@
 from .manager import CondaKernelSpecManager
 from . import _version
 __version__ = _version.get_versions()['version']
+
+
+def _jupyter_server_extension_points():
+    # The extension lives in its own module, so that jupyter_server
+    # remains optional for the kernel spec manager
+    return [{"module": "nb_conda_kernels.handlers"}]
@@ -1,7 +1,134 @@
+import json
+import time
+
 from jupyter_client import kernelspec
 from .manager import CondaKernelSpecManager
 kernelspec.KernelSpecManager = CondaKernelSpecManager
 
-from jupyter_client.kernelspecapp import KernelSpecApp  # noqa
+from jupyter_client.kernelspecapp import KernelSpecApp, ListKernelSpecs  # noqa
+from traitlets import Bool  # noqa
+
+from .doctor import DoctorApp  # noqa
+
+# Number of environment scans printed by `list --timings`; the JSON output has them all
+SLOWEST_SCANS = 10
+
+# The phases of the discovery that run within another one, whose time
+# therefore includes theirs
+PHASE_PARENTS = {
+    'all_envs': 'refresh',
+    'all_kernels': 'refresh',
+    'all_specs': 'refresh',
+    'install_kernelspec': 'all_specs',
+    'remove_stale_kernelspecs': 'all_specs',
+}
+
+
+class Timings(object):
+    """
+    A trace hook of CondaKernelSpecManager that adds up the time spent in
+    each phase of the discovery, and records the scan of each environment.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = {}
+        self.env_scans = []
+
+    def __call__(self, event, phase, attributes):
+        if event != 'end':
+            return
+        if phase == 'scan_env':
+            self.env_scans.append({'env_path': attributes['env_path'],
+                                   'duration': attributes['duration'],
+                                   'kernel_count': attributes.get('kernel_count')})
+        else:
+            self.phases[phase] = self.phases.get(phase, 0) + attributes['duration']
+
+    def report(self):
+        return {
+            'total': time.time() - self.start,
+            'phases': self.phases,
+            'env_scans': sorted(self.env_scans, key=lambda scan: scan['duration'], reverse=True),
+        }
+
+
+class CondaListKernelSpecs(ListKernelSpecs):
+    description = ListKernelSpecs.description + """
+
+    With --timings, also report the time spent in each phase of the
+    discovery of the conda kernels, and in the scan of each environment."""
+
+    timings = Bool(False, config=True,
+                   help="Report the time spent in each phase of the discovery of the "
+                   "conda kernels, and in the scan of each environment, slowest first.")
+
+    flags = dict(ListKernelSpecs.flags, timings=(
+        {"CondaListKernelSpecs": {"timings": True}},
+        "report the time spent discovering the conda kernels.",
+    ))
+
+    def _kernel_spec_manager_default(self):
+        kwargs = {}
+        if self.timings:
+            self._timings = Timings()
+            kwargs['trace_hooks'] = [self._timings]
+        # The kernels are discovered as soon as the manager is created
+        return CondaKernelSpecManager(parent=self, data_dir=self.data_dir, **kwargs)
+
+    def start(self):
+        if not self.timings:
+            return super(CondaListKernelSpecs, self).start()
+        if not self.json_output:
+            specs = super(CondaListKernelSpecs, self).start()
+            self.print_timings(self._timings.report())
+            return specs
+        # The JSON document of ListKernelSpecs, with the timings added
+        specs = self.kernel_spec_manager.get_all_specs()
+        if getattr(self, 'missing_kernels', False):
+            from jupyter_client.kernelspecapp import _limit_to_missing
+            _, specs = _limit_to_missing({}, specs)
+        print(json.dumps({'kernelspecs': specs, 'timings': self._timings.report()}, indent=2))
+        return specs
+
+    @staticmethod
+    def print_timings(report):
+        phases = report['phases']
+
+        def parent(phase):
+            parent = PHASE_PARENTS.get(phase)
+            return parent if parent in phases else None
+
+        def print_phases(parent_phase, depth):
+            # Each nested phase is indented under its parent, which includes its time
+            children = [phase for phase in phases if parent(phase) == parent_phase]
+            for phase in sorted(children, key=lambda phase: -phases[phase]):
+                print("{}{:<{}} {:8.3f}".format("  " * depth, phase, 28 - 2 * depth, phases[phase]))
+                print_phases(phase, depth + 1)
+
+        print("Timings (seconds):")
+        print_phases(None, 1)
+        print("  {:<26} {:8.3f}".format('total', report['total']))
+        env_scans = report['env_scans']
+        if env_scans:
+            print("Environment scans, slowest first:")
+            for scan in env_scans[:SLOWEST_SCANS]:
+                print("  {:8.3f}  {} ({} kernels)".format(
+                    scan['duration'], scan['env_path'], scan['kernel_count']))
+            if len(env_scans) > SLOWEST_SCANS:
+                print("  ... and {} more".format(len(env_scans) - SLOWEST_SCANS))
+
+
+class CondaKernelSpecApp(KernelSpecApp):
+
+    def __init__(self, **kwargs):
+        super(CondaKernelSpecApp, self).__init__(**kwargs)
+        self.subcommands = dict(
+            self.subcommands,
+            list=(CondaListKernelSpecs, ListKernelSpecs.description.splitlines()[0]),
+            doctor=(DoctorApp, DoctorApp.description.splitlines()[0]),
+        )
+
 
-KernelSpecApp.launch_instance()
+if __name__ == '__main__':
+    CondaKernelSpecApp.launch_instance()
@@ -0,0 +1,205 @@
+"""
+Profile the activation of each conda environment, as performed by
+nb_conda_kernels.runner before every kernel launch, and attribute its
+time to the individual activate.d scripts of the environment.
+
+Usage: python -m nb_conda_kernels doctor [--json] [--timeout=SECONDS]
+
+Only the local conda installation is used; nothing is downloaded.
+"""
+from __future__ import print_function
+
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+from jupyter_core.application import JupyterApp, base_flags
+from traitlets import Bool, Float
+
+from .manager import CondaKernelSpecManager
+from .runner import activation_command
+
+is_win = sys.platform.startswith('win')
+
+# Time, in seconds, from which the activation itself (without the activate.d
+# scripts) is reported as slow; conda's own activation often takes a second
+SLOW_ACTIVATION = 2.0
+
+# Patterns of the commands that commonly make an activate.d script slow
+SLOW_COMMANDS = [
+    (re.compile(r'(^|[\s;&|(`])conda(\.exe|\.bat)?\s', re.M),
+     "runs conda, whose startup alone can take a second or more"),
+    (re.compile(r'(^|[\s;&|(`])(python[\d.]*|Rscript|R|java|node|julia)(\.exe)?\s', re.M),
+     "starts an interpreter"),
+    (re.compile(r'(^|[\s;&|(`])(curl|wget|pip|git|ping)(\.exe)?\s', re.M),
+     "may access the network, which is slow or fails offline"),
+]
+
+
+def activate_scripts(env_path):
+    """ The activate.d scripts of an environment, in the order in which
+        conda runs them.
+    """
+    pattern = '*.bat' if is_win else '*.sh'
+    return sorted(glob.glob(os.path.join(env_path, 'etc', 'conda', 'activate.d', pattern)))
+
+
+def _timed_run(cmd, timeout, env=None):
+    """ Run a command. Returns its duration, its output, and an error
+        message if it failed or timed out.
+    """
+    start = time.time()
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                stdin=subprocess.DEVNULL, timeout=timeout, env=env)
+    except subprocess.TimeoutExpired:
+        return time.time() - start, '', 'did not finish within {} seconds'.format(timeout)
+    except OSError as err:
+        return time.time() - start, '', str(err)
+    duration = time.time() - start
+    output = result.stdout.decode('utf-8', 'replace')
+    if result.returncode:
+        return duration, output, 'exited with status {}'.format(result.returncode)
+    return duration, output, None
+
+
+def _script_env(env_path):
+    # The variables an activate.d script finds once its environment is activated
+    if is_win:
+        dirs = [env_path, os.path.join(env_path, 'Library', 'bin'), os.path.join(env_path, 'Scripts')]
+    else:
+        dirs = [os.path.join(env_path, 'bin')]
+    path = os.pathsep.join(dirs + [os.environ.get('PATH', '')])
+    return dict(os.environ, CONDA_PREFIX=env_path, PATH=path)
+
+
+def profile_script(script, env_path, timeout, slow_threshold):
+    """ Time an activate.d script on its own, and suggest how to make it
+        faster if it is slow.
+    """
+    if is_win:
+        cmd = [os.environ['COMSPEC'], '/S', '/C', 'call', script]
+    else:
+        cmd = ['bash', '-c', '. "$1"', 'doctor', script]
+    duration, _, error = _timed_run(cmd, timeout, env=_script_env(env_path))
+    suggestions = []
+    if error:
+        suggestions.append("fails when run on its own ({}); its time may be underestimated".format(error))
+    if duration >= slow_threshold:
+        suggestions.append("adds {:.2f} seconds to every kernel launch; move the expensive work "
+                           "out of activate.d, or cache its result".format(duration))
+        try:
+            with open(script, 'rb') as fp:
+                content = fp.read().decode('utf-8', 'replace')
+        except OSError:
+            content = ''
+        # Comments are not run
+        content = re.sub(r'^\s*(#|rem\b|::).*$', '', content, flags=re.M | re.I)
+        suggestions.extend(message for pattern, message in SLOW_COMMANDS if pattern.search(content))
+    return {'path': script, 'duration': duration, 'error': error, 'suggestions': suggestions}
+
+
+def profile_env(conda_prefix, env_name, env_path, timeout, slow_threshold):
+    """ Time the activation of an environment as a whole, as performed by
+        nb_conda_kernels.runner, and each of its activate.d scripts.
+    """
+    report = {'env_name': env_name, 'env_path': env_path, 'activated': env_path != sys.prefix,
+              'activation': 0.0, 'error': None, 'scripts': [], 'suggestions': []}
+    if not report['activated']:
+        # The kernels of the current environment are run without activation
+        return report
+    cmd = activation_command(conda_prefix, env_path, 'rem' if is_win else 'true')
+    duration, output, error = _timed_run(cmd, timeout)
+    if error is None and 'CONDA_PREFIX=' + env_path not in output:
+        error = 'did not activate the environment'
+    report['activation'] = duration
+    report['error'] = error
+    scripts = [profile_script(script, env_path, timeout, slow_threshold)
+               for script in activate_scripts(env_path)]
+    report['scripts'] = sorted(scripts, key=lambda script: script['duration'], reverse=True)
+    overhead = duration - sum(script['duration'] for script in scripts)
+    if error:
+        report['suggestions'].append("the activation {}; kernels of this environment may not "
+                                     "start".format(error))
+    elif overhead >= max(slow_threshold, SLOW_ACTIVATION):
+        report['suggestions'].append(
+            "the activation takes {:.2f} seconds besides its activate.d scripts; check the conda "
+            "installation, e.g. with `conda info`".format(overhead))
+    return report
+
+
+class DoctorApp(JupyterApp):
+    """An app to profile the activation of the conda environments."""
+
+    name = "nb_conda_kernels doctor"
+    description = """Profile the activation of each conda environment.
+
+    Kernels of conda environments are started after the activation of
+    their environment, which runs its activate.d scripts. This times
+    the activation of each environment, and each of its scripts, and
+    suggests how to speed up the slowest ones."""
+
+    json_output = Bool(False, config=True,
+                       help="Output the report as machine-readable JSON.")
+    timeout = Float(60, config=True,
+                    help="Maximum time, in seconds, to wait for an activation or a script.")
+    slow_threshold = Float(0.5, config=True,
+                           help="Time, in seconds, from which an activate.d script is "
+                           "reported as slow.")
+
+    flags = {
+        "json": ({"DoctorApp": {"json_output": True}}, "output the report as machine-readable json."),
+        "debug": base_flags["debug"],
+    }
+    aliases = {
+        "timeout": "DoctorApp.timeout",
+        "slow": "DoctorApp.slow_threshold",
+    }
+
+    def profile(self):
+        """ Profile every environment found by CondaKernelSpecManager.
+            Returns their reports, slowest activation first.
+        """
+        manager = CondaKernelSpecManager(parent=self)
+        conda_info = manager._conda_info
+        if conda_info is None:
+            self.log.error("nb_conda_kernels | conda is not available")
+            return []
+        reports = [profile_env(conda_info['conda_prefix'], env_name, env_path,
+                               self.timeout, self.slow_threshold)
+                   for env_name, env_path in manager._all_envs().items()]
+        return sorted(reports, key=lambda report: report['activation'], reverse=True)
+
+    def start(self):
+        reports = self.profile()
+        if self.json_output:
+            print(json.dumps({'environments': reports}, indent=2))
+            return reports
+        print("Environment activation, slowest first (seconds):")
+        for report in reports:
+            if not report['activated']:
+                print("      -  {}  {} (current environment, not activated)".format(
+                    report['env_name'], report['env_path']))
+                continue
+            print("  {:7.3f}  {}  {}".format(report['activation'], report['env_name'], report['env_path']))
+            for script in report['scripts']:
+                print("    {:7.3f}  {}".format(script['duration'], os.path.basename(script['path'])))
+        suggestions = [(report, script, suggestion)
+                       for report in reports
+                       for script in [None] + report['scripts']
+                       for suggestion in (script or report)['suggestions']]
+        if not suggestions:
+            print("No slow activation found.")
+            return reports
+        print("Suggestions:")
+        for report, script, suggestion in suggestions:
+            print("  {}: {}".format(report['env_name'] if script is None else script['path'], suggestion))
+        return reports
+
+
+if __name__ == '__main__':
+    DoctorApp.launch_instance()
@@ -0,0 +1,121 @@
+"""
+An optional jupyter_server extension serving the kernel specs at
+/api/conda/kernelspecs, in the format of /api/kernelspecs, with an ETag:
+polling an unchanged list then costs neither its payload nor building
+its kernel specs, but only a stat of each kernel.json. A POST to the
+same URL refreshes the kernels in the background, e.g. right after an
+environment has been created.
+
+Enable it with `jupyter server extension enable nb_conda_kernels`.
+"""
+import asyncio
+import hashlib
+import json
+import os
+
+from tornado import web
+
+from jupyter_server.auth.decorator import authorized
+from jupyter_server.base.handlers import APIHandler
+from jupyter_server.services.kernelspecs.handlers import kernelspec_model
+from jupyter_server.utils import url_path_join
+
+from .manager import CondaKernelSpecManager
+
+AUTH_RESOURCE = "kernelspecs"
+
+# Running refreshes, referenced until they are done
+_refreshes = set()
+
+
+def kernelspecs_etag(generation, kernel_specs, default_kernel, fingerprints):
+    """ A strong ETag for a kernel spec listing, from the generation of
+        the conda kernels and a digest of the name, resource directory and
+        kernel.json fingerprint of every kernel, which also covers the
+        standard Jupyter kernels.
+    """
+    data = json.dumps([default_kernel, sorted((name, resource_dir, fingerprints.get(name))
+                                              for name, resource_dir in kernel_specs.items())])
+    return '"{}-{}"'.format(generation, hashlib.sha1(data.encode('utf-8')).hexdigest()[:16])
+
+
+def kernelspec_fingerprints(ksm, kernel_specs):
+    """ The modification time and size of the kernel.json from which the
+        spec of each kernel is built: as of its loading for the conda kernels
+        already loaded, whose spec is kept until the next refresh, and as of
+        now for the others. Requires a stat of each kernel.json, so it is
+        run in an executor.
+    """
+    snapshot = ksm._snapshot
+    conda_kernels = {} if snapshot is None else snapshot.kernels
+    fingerprints = {}
+    for name, resource_dir in kernel_specs.items():
+        kernel = conda_kernels.get(name)
+        if kernel is not None and kernel.loaded and kernel.fingerprint is not None:
+            fingerprints[name] = kernel.fingerprint
+            continue
+        try:
+            st = os.stat(os.path.join(resource_dir, 'kernel.json'))
+            fingerprints[name] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            fingerprints[name] = None
+    return fingerprints
+
+
+def current_generation(ksm):
+    """ The generation of the last refresh of the conda kernels. Unlike
+        ksm.generation, it never refreshes them on the event loop.
+    """
+    snapshot = ksm._snapshot
+    return 0 if snapshot is None else snapshot.generation
+
+
+class CondaKernelSpecsHandler(APIHandler):
+    auth_resource = AUTH_RESOURCE
+
+    @web.authenticated
+    @authorized
+    async def get(self):
+        ksm = self.kernel_spec_manager
+        kernel_specs = await ksm.async_find_kernel_specs()
+        fingerprints = await asyncio.get_running_loop().run_in_executor(
+            None, kernelspec_fingerprints, ksm, kernel_specs)
+        default_kernel = self.kernel_manager.default_kernel_name
+        self.set_header("ETag", kernelspecs_etag(
+            current_generation(ksm), kernel_specs, default_kernel, fingerprints))
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+
+        model = {"default": default_kernel, "kernelspecs": {}}
+        for name, info in (await ksm.async_get_all_specs()).items():
+            try:
+                model["kernelspecs"][name] = kernelspec_model(
+                    self, name, info["spec"], info["resource_dir"])
+            except Exception:
+                self.log.error("Failed to load kernel spec: '%s'", name, exc_info=True)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(model))
+
+    @web.authenticated
+    @authorized
+    async def post(self):
+        ksm = self.kernel_spec_manager
+        task = asyncio.ensure_future(ksm.async_refresh())
+        _refreshes.add(task)
+        task.add_done_callback(_refreshes.discard)
+        self.set_status(202)
+        self.finish(json.dumps({"generation": current_generation(ksm)}))
+
+
+def _load_jupyter_server_extension(serverapp):
+    if not isinstance(serverapp.kernel_spec_manager, CondaKernelSpecManager):
+        serverapp.log.warning(
+            "nb_conda_kernels | the kernel spec manager is not a CondaKernelSpecManager; "
+            "/api/conda/kernelspecs is not available.")
+        return
+    base_url = serverapp.web_app.settings["base_url"]
+    serverapp.web_app.add_handlers(".*$", [
+        (url_path_join(base_url, "api", "conda", "kernelspecs"), CondaKernelSpecsHandler),
+    ])
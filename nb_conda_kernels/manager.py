@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import fnmatch
 import json
 import re
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
 import shutil
 import subprocess
 import threading
@@ -8,43 +12,358 @@ import sys
 import time
 import glob
 import psutil
+import queue
+from concurrent.futures import Future, wait
+from types import MappingProxyType
 
 import os
+import pathlib
 from os.path import join, split, dirname, basename, abspath
-from traitlets import Bool, Unicode, TraitError, validate
+from traitlets import Any, Bool, Dict, Enum, Float, Integer, List, Unicode, TraitError, validate
 
 from jupyter_client.kernelspec import KernelSpecManager, KernelSpec, NoSuchKernel
 
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+from .metrics import (CACHE_REQUESTS, CONDA_INFO_DURATION_SECONDS, CONDA_INFO_FAILURES,
+                      CONDA_KERNELS, DISCOVERY_DURATION_SECONDS, ENVS_SCANNED,
+                      KERNELSPECS_WRITTEN)
+
 CACHE_TIMEOUT = 60
 
+# Delays, in seconds, before retrying a failed conda call; doubled at each failure
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 600
+
 CONDA_EXE = os.environ.get("CONDA_EXE", "conda")
 
 RUNNER_COMMAND = ['python', '-m', 'nb_conda_kernels.runner']
 
-_canonical_paths = {}
+CANONICAL_PATHS_SIZE = 10000
+
+SCAN_WORKERS = 8
+
+# The part of conda info that the kernel discovery depends on
+SNAPSHOT_CONDA_INFO = ('conda_prefix', 'root_prefix', 'envs', 'envs_dirs')
+
+# Number of change sets remembered for changes_since
+CHANGE_HISTORY = 100
+
+# The jupyter_events schema of the kernel changes
+EVENT_SCHEMA_ID = 'https://events.jupyter.org/nb_conda_kernels/kernelspecs/v1'
+EVENT_SCHEMA_PATH = pathlib.Path(__file__).parent / 'event_schemas' / 'kernelspecs' / 'v1.yaml'
+
+# The OpenTelemetry tracer of the discovery phases, if available
+_tracer = None if otel_trace is None else otel_trace.get_tracer("nb_conda_kernels")
+
+# Case sensitivity of each filesystem, keyed by st_dev
+_case_sensitive_devices = {}
 
 
-def _canonicalize(path):
+def _case_sensitivity(path, st):
     """
-    On case-sensitive filesystems, return the path unchanged.
-    On case-insensitive filesystems, cache the first value of
-    the path that we encounter, and return that for any other
-    case variation.
+    Determine whether the filesystem holding path is case-sensitive,
+    by comparing its inode with those of its case variations. Returns
+    None if the path has no case variations to compare.
     """
-    def _inode(p):
+    sensitive = None
+    for variant in (path.lower(), path.upper()):
+        if variant == path:
+            continue
         try:
-            return os.stat(p).st_ino
-        except FileNotFoundError:
-            return -1
-    inode1 = _inode(path)
-    plower = path.lower()
-    inode2 = _inode(plower)
-    if inode1 != inode2:
-        return path
-    inode3 = _inode(path.upper())
-    if inode3 != inode2:
-        return path
-    return _canonical_paths.setdefault(plower, path)
+            inode = os.stat(variant).st_ino
+        except OSError:
+            inode = -1
+        if inode != st.st_ino:
+            return True
+        sensitive = False
+    return sensitive
+
+
+class _CanonicalPaths(object):
+    """
+    A bounded cache of canonical paths, evicting the least recently
+    used entries, so that paths of deleted environments do not
+    accumulate over the life of the server.
+
+    Calling it with a path returns the path unchanged on case-sensitive
+    filesystems. On case-insensitive filesystems, it returns the first
+    value of the path that we encountered for any other case variation.
+
+    The case sensitivity is determined once per filesystem, and the
+    result for each path is remembered, so that a path seen before
+    costs no system calls at all. A function can be given in place of
+    os.stat, e.g. to use stats already made in the background.
+    """
+
+    def __init__(self, maxsize=CANONICAL_PATHS_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # Canonical value of every path seen recently
+        self._paths = OrderedDict()
+        # First case variation seen of each path on case-insensitive filesystems
+        self._folded = OrderedDict()
+        # Guards both caches, which are shared by the threads of the async
+        # API and of the scan pool; the stats are made without it
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._paths)
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        if len(cache) > self.maxsize:
+            cache.popitem(last=False)
+
+    def __call__(self, path, stat=None):
+        with self._lock:
+            result = self._paths.get(path)
+            if result is not None:
+                self.hits += 1
+                self._paths.move_to_end(path)
+                return result
+            self.misses += 1
+        try:
+            st = (stat or os.stat)(path)
+        except OSError:
+            # Nothing to compare against yet; do not remember the result
+            with self._lock:
+                return self._folded.get(path.lower(), path)
+        sensitive = _case_sensitive_devices.get(st.st_dev)
+        if sensitive is None:
+            sensitive = _case_sensitivity(path, st)
+            if sensitive is not None:
+                _case_sensitive_devices[st.st_dev] = sensitive
+        result = path
+        with self._lock:
+            if sensitive is False:
+                plower = path.lower()
+                result = self._folded.get(plower, path)
+                if plower in self._folded:
+                    self._folded.move_to_end(plower)
+                else:
+                    self._remember(self._folded, plower, path)
+            self._remember(self._paths, path, result)
+        return result
+
+
+# Shared instance for callers outside of a CondaKernelSpecManager
+_canonicalize = _CanonicalPaths()
+
+
+def _stat_env(path):
+    """
+    Stat an environment directory, and determine the case sensitivity of
+    its filesystem if it is not known yet, so that canonicalizing the
+    path afterwards requires no system call.
+    """
+    st = os.stat(path)
+    if st.st_dev not in _case_sensitive_devices:
+        sensitive = _case_sensitivity(path, st)
+        if sensitive is not None:
+            _case_sensitive_devices[st.st_dev] = sensitive
+    return st
+
+
+def _intern_all(values):
+    return tuple(sys.intern(v) if isinstance(v, str) else v for v in values)
+
+
+class _CondaEnv(object):
+    """
+    A conda environment holding kernels. It is shared by all of its
+    kernels, along with the argv prefix that runs them inside it.
+    """
+    __slots__ = ('name', 'path', 'is_base', 'is_current', 'argv_prefix')
+
+    def __init__(self, name, path, is_base, conda_prefix):
+        self.name = sys.intern(name)
+        self.path = sys.intern(path)
+        self.is_base = is_base
+        self.is_current = path == sys.prefix
+        if self.is_current:
+            self.argv_prefix = ()
+        else:
+            self.argv_prefix = _intern_all(RUNNER_COMMAND + [conda_prefix, path])
+
+
+class _CondaKernel(object):
+    """
+    A kernel found in a conda environment, in a compact form since
+    there may be thousands of them. Listing the kernels only requires
+    their location; the fields of the kernel spec are read and memoized
+    by CondaKernelSpecManager._load_kernel when needed, along with the
+    modification time and size of the kernel.json they were read from.
+    A KernelSpec is only built from them when one is requested.
+    """
+    __slots__ = ('name', 'env', 'raw_name', 'resource_dir', 'loaded',
+                 'display_name', 'display_prefix', 'language', 'argv',
+                 'variables', 'interrupt_mode', 'metadata', 'extra',
+                 'fingerprint')
+
+    def __init__(self, name, env, kernel_dir):
+        self.name = name
+        self.env = env
+        self.resource_dir = abspath(kernel_dir)
+        self.raw_name = sys.intern(basename(kernel_dir))
+        self.loaded = False
+        # argv is None when the kernel.json could not be loaded
+        self.argv = None
+        self.fingerprint = None
+
+    def to_json(self):
+        """ The content of the kernel.json, modified so that it can be
+            run properly in its native environment.
+        """
+        env = self.env
+        metadata = dict(self.metadata or ())
+        metadata.update({
+            'conda_env_name': env.name,
+            'conda_env_path': env.path,
+            'conda_language': self.display_prefix,
+            'conda_raw_kernel_name': self.raw_name,
+            'conda_is_base_environment': env.is_base,
+            'conda_is_currently_running': env.is_current
+        })
+        spec = dict(self.extra or ())
+        spec.update({
+            'argv': list(env.argv_prefix + self.argv),
+            'display_name': self.display_name,
+            'metadata': metadata,
+        })
+        if self.language is not None:
+            spec['language'] = self.language
+        if self.variables is not None:
+            spec['env'] = dict(self.variables)
+        if self.interrupt_mode is not None:
+            spec['interrupt_mode'] = self.interrupt_mode
+        return spec
+
+    def to_kernel_spec(self):
+        return KernelSpec(resource_dir=self.resource_dir, **self.to_json())
+
+
+class _Snapshot(namedtuple('_Snapshot', 'generation timestamp expiry conda_info envs kernels')):
+    """
+    The result of a discovery of the conda kernels: the conda info it
+    used, the environments (name to path) and the kernels (name to
+    _CondaKernel). A refresh never modifies a snapshot, whose maps are
+    read-only, but replaces it as a whole, so that readers always see
+    a consistent view without taking a lock. The generation is only
+    incremented when the set of kernels changes.
+    """
+    __slots__ = ()
+
+    def expired(self):
+        return self.expiry < time.time()
+
+
+class _ScanPool(object):
+    """
+    A few daemon threads running environment scans. A scan stuck on an
+    unresponsive mount then neither blocks the caller, which waits on the
+    returned future with a timeout, nor the exit of the process.
+
+    Each future records the time at which its scan started, as its
+    `started` attribute, so that every scan can be given its own deadline.
+    """
+
+    def __init__(self, workers=SCAN_WORKERS):
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # Start time of the current scan of each thread, or None if idle
+        self._started = {}
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.started = None
+        self._queue.put((future, fn, args))
+        with self._lock:
+            if len(self._started) < self.workers:
+                self._start_thread()
+        return future
+
+    def replace_stuck(self, timeout):
+        """ Start a new thread for each one running a scan for more than
+            timeout seconds, so that the queued scans do not wait for it.
+        """
+        now = time.time()
+        with self._lock:
+            active = sum(1 for started in self._started.values()
+                         if started is None or now - started < timeout)
+            for _ in range(self.workers - active):
+                self._start_thread()
+
+    def _start_thread(self):
+        thread = threading.Thread(target=self._run, name='nb_conda_kernels-scan')
+        thread.daemon = True
+        self._started[thread] = None
+        thread.start()
+
+    def _run(self):
+        thread = threading.current_thread()
+        while True:
+            future, fn, args = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            future.started = self._started[thread] = time.time()
+            try:
+                future.set_result(fn(*args))
+            except BaseException as err:
+                future.set_exception(err)
+            with self._lock:
+                self._started[thread] = None
+                if len(self._started) > self.workers:
+                    # Replaced while stuck: leave the pool
+                    del self._started[thread]
+                    return
+
+
+class _EnvMatcher(object):
+    """
+    Decides which environments to scan, from the env_* options of
+    CondaKernelSpecManager, compiled once. The tests
+    on the path come first; the ownership test, which requires a stat,
+    is done last and only if it is enabled.
+    """
+
+    def __init__(self, exclude=None, include=(), globs=(), owner_only=False, max_depth=None):
+        self.exclude = re.compile(exclude) if exclude else None
+        # Each pattern is compiled on its own, so that its inline flags
+        # apply to it alone
+        patterns = list(include)
+        patterns.extend('^' + fnmatch.translate(glob_) for glob_ in globs)
+        self.include = tuple(re.compile(pattern) for pattern in patterns) or None
+        self.uid = os.getuid() if owner_only and hasattr(os, 'getuid') else None
+        self.max_depth = max_depth
+
+    def match_path(self, env_path):
+        """ The tests on the path alone, which require no system call.
+        """
+        if self.exclude is not None and self.exclude.search(env_path):
+            return False
+        if self.include is not None and not any(p.search(env_path) for p in self.include):
+            return False
+        if self.max_depth is not None:
+            depth = sum(1 for part in env_path.split(os.sep) if part)
+            if depth > self.max_depth:
+                return False
+        return True
+
+    def __call__(self, env_path, stat=None):
+        if not self.match_path(env_path):
+            return False
+        if self.uid is not None:
+            try:
+                return (stat or os.stat)(env_path).st_uid == self.uid
+            except OSError:
+                return False
+        return True
 
 
 class CondaKernelSpecManager(KernelSpecManager):
@@ -59,8 +378,55 @@ class CondaKernelSpecManager(KernelSpecManager):
                       help="Include only the kernels not visible from Jupyter normally. If False, any "
                       "duplication will be resolved in favor of nb_conda_kernels. This is assumed to "
                       "be true if kernelspec_path is supplied as well.")
+    conda_info_cache_timeout = Float(CACHE_TIMEOUT, config=True,
+                                     help="Time, in seconds, before the output of `conda info` "
+                                     "is refreshed; that is, before new environments are found.")
+    kernels_cache_timeout = Float(CACHE_TIMEOUT, config=True,
+                                  help="Time, in seconds, before the kernels found in the "
+                                  "environments are refreshed.")
+    adaptive_cache_timeout = Bool(False, config=True,
+                                  help="Adapt the cache timeouts to how often the environments change: "
+                                  "each refresh that finds no change doubles the timeout, and each one "
+                                  "that does halves it, within min_cache_timeout and max_cache_timeout.")
+    min_cache_timeout = Float(10, config=True,
+                              help="Lower bound of the cache timeouts in adaptive mode.")
+    max_cache_timeout = Float(600, config=True,
+                              help="Upper bound of the cache timeouts in adaptive mode.")
+    conda_info_fingerprint = Bool(True, config=True,
+                                  help="Skip the refresh of `conda info` while the files that determine "
+                                  "the environment list (environments.txt, condarc files and envs "
+                                  "directories) are unchanged, and reuse its previous output.")
+    conda_timeout = Float(60, config=True, allow_none=True,
+                          help="Maximum time, in seconds, to wait for `conda info`. A conda call "
+                          "that fails or times out is retried with an exponential backoff, and the "
+                          "last successful result is used in the meantime. If None, wait forever.")
+    conda_info_file = Unicode(None, config=True, allow_none=True,
+                              help="Optional file in which to save the last successful `conda info` "
+                              "result, so that it is available to a new server started while "
+                              "conda is failing.")
     env_filter = Unicode(None, config=True, allow_none=True,
                          help="Exclude kernels from environments that match this regex.")
+    env_include = List(Unicode(), config=True,
+                       help="Include only kernels from environments whose path matches one of "
+                       "these regexes, or one of the env_include_glob patterns. An empty list, "
+                       "the default, includes all environments.")
+    env_include_glob = List(Unicode(), config=True,
+                            help="Include only kernels from environments whose full path matches "
+                            "one of these glob patterns, or one of the env_include regexes. An "
+                            "empty list, the default, includes all environments.")
+    env_owner_only = Bool(False, config=True,
+                          help="Include only kernels from environments owned by the current user. "
+                          "Ignored on platforms without user ids, such as Windows.")
+    env_max_depth = Integer(None, config=True, allow_none=True,
+                            help="Exclude kernels from environments whose path has more than this "
+                            "number of components; e.g. /opt/conda/envs/py has 4.")
+    env_path_preference = Enum(['first', 'shortest', 'realpath'], 'first',
+                               config=True, allow_none=True,
+                               help="Which path to use for an environment listed more than once "
+                               "through different paths, such as symbolic links: 'first' keeps the "
+                               "first one listed by conda, 'shortest' the shortest one, and 'realpath' "
+                               "the fully resolved path. The base environment always keeps its own "
+                               "path. If None, every listed path is scanned as a separate environment.")
     kernelspec_path = Unicode(None, config=True, allow_none=True,
         help="""Path to install conda kernel specs to.
 
@@ -75,10 +441,43 @@ class CondaKernelSpecManager(KernelSpecManager):
 
         If None, the conda kernel specs will only be available dynamically on notebook editors.
         """)
+    env_scan_timeout = Float(None, config=True, allow_none=True,
+                             help="Maximum time, in seconds, to wait for the kernels of an "
+                             "environment to be listed. The environments are then scanned "
+                             "concurrently; one that takes longer, e.g. on an unresponsive network "
+                             "mount, is served from its last known kernels, or omitted if there are "
+                             "none, while its scan completes in the background. The environment "
+                             "directories are stat'd in the same way, each within this time. If "
+                             "None, the environments are scanned one after the other without any limit.")
+    allowed_languages = List(Unicode(), config=True,
+                             help="Include only the conda kernels whose kernel spec declares one "
+                             "of these languages (case-insensitive). An empty list, the default, "
+                             "includes all languages.")
     enable_debugger = Bool(None, config=True, allow_none=True,
                            help="Optional: Override debugger setting in kernelspec metadata. "
                            "If this parameter is unset it will default to the source kernel metadata.")
 
+    canonical_paths_size = Integer(CANONICAL_PATHS_SIZE, config=True,
+                                   help="Maximum number of environment and kernel paths whose "
+                                   "canonical form is remembered. The least recently used "
+                                   "paths are forgotten first.")
+
+    kernel_changes = Dict(help="The change set of the last refresh that changed the conda kernels: "
+                          "a dict with the new 'generation', and the sorted lists of kernel names "
+                          "'added', 'removed' and 'changed' (found in a different directory). "
+                          "It can be observed to process only the differences.")
+    trace_hooks = List(config=True,
+                       help="Callables called around each phase of the discovery, as "
+                       "hook(event, phase, attributes) with event 'start' or 'end'. The phases "
+                       "are conda_info, refresh, all_envs, all_kernels, scan_env, all_specs, "
+                       "install_kernelspec, remove_stale_kernelspecs and kernel_specs (in "
+                       "get_all_specs). At the end, the "
+                       "attributes also include the duration, counts, and any error.")
+    event_logger = Any(None, allow_none=True,
+                       help="The jupyter_events EventLogger to which the changes of the conda "
+                       "kernels are emitted. If None, that of the parent application is used, "
+                       "if any; e.g. jupyter_server's.")
+
     @validate("kernelspec_path")
     def _validate_kernelspec_path(self, proposal):
         new_value = proposal["value"]
@@ -108,15 +507,41 @@ class CondaKernelSpecManager(KernelSpecManager):
     def __init__(self, **kwargs):
         super(CondaKernelSpecManager, self).__init__(**kwargs)
 
+        self._canonicalize = _CanonicalPaths(self.canonical_paths_size)
+
         self._conda_info_cache = None
         self._conda_info_cache_expiry = None
         self._conda_info_cache_thread = None
+        self._conda_info_failures = 0
+        self._conda_info_task = None
+        self._conda_info_fingerprint = None
+        self._conda_info_ttl = self.conda_info_cache_timeout
 
-        self._conda_kernels_cache = None
-        self._conda_kernels_cache_expiry = None
+        # The current _Snapshot, replaced by one thread at a time
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
+        self._conda_kernels_ttl = self.kernels_cache_timeout
+        # The last change sets, oldest first
+        self._changes = deque(maxlen=CHANGE_HISTORY)
+        # The event loop of the async API, on which the events are emitted
+        self._event_loop = None
 
-        if self.env_filter is not None:
-            self._env_filter_regex = re.compile(self.env_filter)
+        # (key, expiry, kernel specs) of the standard Jupyter kernels
+        self._native_kernels_cache = None
+
+        # Last known kernel directories, and unfinished scans, of each environment
+        self._env_scans = {}
+        self._pending_scans = {}
+        self._pending_stats = {}
+        self._scan_pool = None
+
+        self._env_matcher = _EnvMatcher(
+            exclude=self.env_filter,
+            include=self.env_include,
+            globs=self.env_include_glob,
+            owner_only=self.env_owner_only,
+            max_depth=self.env_max_depth
+        )
 
         self._kernel_user = self.kernelspec_path == "--user"
         self._kernel_prefix = None
@@ -127,6 +552,47 @@ class CondaKernelSpecManager(KernelSpecManager):
             "nb_conda_kernels | enabled, %s kernels found.", len(self._conda_kspecs)
         )
 
+    @contextmanager
+    def _trace(self, phase, **attributes):
+        """ Trace a phase of the discovery: call the trace_hooks, and record
+            an OpenTelemetry span if opentelemetry is installed. Yields the
+            attributes, which the phase can complete with its results; their
+            duration is set at the end in any case.
+        """
+        hooks = self.trace_hooks
+        start = time.time()
+        if not hooks and _tracer is None:
+            try:
+                yield attributes
+            finally:
+                attributes['duration'] = time.time() - start
+            return
+        for hook in hooks:
+            self._call_hook(hook, 'start', phase, attributes)
+        try:
+            if _tracer is None:
+                yield attributes
+            else:
+                with _tracer.start_as_current_span('nb_conda_kernels.' + phase) as span:
+                    try:
+                        yield attributes
+                    finally:
+                        span.set_attributes({k: v for k, v in attributes.items()
+                                             if isinstance(v, (str, bool, int, float))})
+        except Exception as err:
+            attributes['error'] = str(err)
+            raise
+        finally:
+            attributes['duration'] = time.time() - start
+            for hook in hooks:
+                self._call_hook(hook, 'end', phase, attributes)
+
+    def _call_hook(self, hook, event, phase, attributes):
+        try:
+            hook(event, phase, attributes)
+        except Exception as err:
+            self.log.warning("nb_conda_kernels | trace hook %r failed:\n%s", hook, err)
+
     @staticmethod
     def clean_kernel_name(kname):
         """ Replaces invalid characters in the Jupyter kernelname, with
@@ -147,86 +613,322 @@ class CondaKernelSpecManager(KernelSpecManager):
     def _conda_info(self):
         """ Get and parse the whole conda information output
 
-            Caches the information for CACHE_TIMEOUT seconds, as this is
-            relatively expensive.
+            Caches the information for conda_info_cache_timeout seconds, as
+            this is relatively expensive.
         """
 
-        def get_conda_info_data():
+        def get_conda_info_data(mode):
           # This is to make sure that subprocess can find 'conda' even if
           # it is a Windows batch file---which is the case in non-root
           # conda environments.
           shell = CONDA_EXE == 'conda' and sys.platform.startswith('win')
-          try:
-            # Let json do the decoding for non-ASCII characters
-            out = subprocess.check_output([CONDA_EXE, "info", "--json"], shell=shell)
-            conda_info = json.loads(out)
-            return conda_info, None
-          except Exception as err:
-            return None, err
-          finally:
-             self.wait_for_child_processes_cleanup()
+          CACHE_REQUESTS.labels('conda_info', 'miss').inc()
+          with self._trace('conda_info', mode=mode) as attributes:
+            try:
+              # Let json do the decoding for non-ASCII characters
+              out = subprocess.check_output([CONDA_EXE, "info", "--json"], shell=shell,
+                                            timeout=self.conda_timeout)
+              conda_info = json.loads(out)
+              attributes['env_count'] = len(conda_info.get('envs') or ())
+              result = conda_info, None
+            except Exception as err:
+              attributes['error'] = str(err)
+              result = None, err
+            finally:
+               self.wait_for_child_processes_cleanup()
+          CONDA_INFO_DURATION_SECONDS.observe(attributes['duration'])
+          return result
 
         class CondaInfoThread(threading.Thread):
           def run(self):
-            self.out, self.err = get_conda_info_data()
+            self.out, self.err = get_conda_info_data('background')
 
         expiry = self._conda_info_cache_expiry
         t = self._conda_info_cache_thread
+        task = self._conda_info_task
 
         # cache is empty
         if expiry is None:
           self.log.debug("nb_conda_kernels | refreshing conda info (blocking call)")
-          conda_info, err = get_conda_info_data()
-          if conda_info is None:
-            self.log.error("nb_conda_kernels | couldn't call conda:\n%s", err)
-          self._conda_info_cache = conda_info
-          self._conda_info_cache_expiry = time.time() + CACHE_TIMEOUT
+          fingerprint = self._conda_info_key()
+          self._store_conda_info(*get_conda_info_data('blocking'), fingerprint=fingerprint)
 
         # subprocess just finished
         elif t and not t.is_alive():
           t.join()
-          conda_info = t.out
-          if conda_info is None:
-            self.log.error("nb_conda_kernels | couldn't call conda:\n%s", t.err)
-          else:
+          if t.out is not None:
             self.log.debug("nb_conda_kernels | collected conda info (async call)")
-          self._conda_info_cache = conda_info
-          self._conda_info_cache_expiry = time.time() + CACHE_TIMEOUT
+          self._store_conda_info(t.out, t.err, fingerprint=t.fingerprint)
           self._conda_info_cache_thread = None
 
+        # refresh running in the event loop of the async API
+        elif task is not None and not task.done():
+          pass
+
         # cache expired
         elif not t and expiry < time.time():
-          self.log.debug("nb_conda_kernels | refreshing conda info (async call)")
-          t = CondaInfoThread()
-          t.start()
-          self._conda_info_cache_thread = t
+          fingerprint = self._conda_info_key()
+          if self._reuse_conda_info(fingerprint):
+            pass
+          else:
+            self.log.debug("nb_conda_kernels | refreshing conda info (async call)")
+            t = CondaInfoThread()
+            t.fingerprint = fingerprint
+            t.start()
+            self._conda_info_cache_thread = t
 
         # else, just return cache
 
         return self._conda_info_cache
 
+    def _next_cache_timeout(self, name, timeout, default, changed):
+        """ Returns the time until the next refresh of a cache, given its
+            current timeout and whether the last refresh found a change.
+
+            In adaptive mode, the timeout is halved after a change, and
+            doubled otherwise, within min/max_cache_timeout. Otherwise
+            the configured default is used.
+        """
+        if not self.adaptive_cache_timeout:
+            timeout = default
+        elif changed:
+            timeout = max(self.min_cache_timeout, timeout / 2.0)
+        else:
+            timeout = min(self.max_cache_timeout, timeout * 2.0)
+        self.log.debug("nb_conda_kernels | %s %s; next refresh in %s seconds",
+                       name, "changed" if changed else "unchanged", timeout)
+        return timeout
+
+    def _reuse_conda_info(self, fingerprint):
+        """ If the conda configuration is unchanged since the last successful
+            conda info call, record its result as refreshed and return True.
+        """
+        if (self.conda_info_fingerprint and self._conda_info_cache is not None and
+                fingerprint == self._conda_info_fingerprint):
+            self.log.debug("nb_conda_kernels | conda configuration unchanged, reusing conda info")
+            CACHE_REQUESTS.labels('conda_info', 'hit').inc()
+            self._store_conda_info(self._conda_info_cache, None, fingerprint=fingerprint)
+            return True
+        return False
+
+    def _check_conda_output(self, cmd, shell):
+        """ Run conda with a blocking call, for the event loops that
+            cannot run subprocesses.
+        """
+        try:
+            return subprocess.check_output(cmd, shell=shell, timeout=self.conda_timeout)
+        finally:
+            self.wait_for_child_processes_cleanup()
+
+    async def _async_refresh_conda_info(self):
+        """ Run `conda info` as an asyncio subprocess, and store its result.
+        """
+        fingerprint = self._conda_info_key()
+        if self._reuse_conda_info(fingerprint):
+            return
+        self.log.debug("nb_conda_kernels | refreshing conda info (asyncio)")
+        cmd = [CONDA_EXE, "info", "--json"]
+        CACHE_REQUESTS.labels('conda_info', 'miss').inc()
+        with self._trace('conda_info', mode='asyncio') as attributes:
+            try:
+                # See _conda_info for the use of a shell on Windows
+                shell = CONDA_EXE == 'conda' and sys.platform.startswith('win')
+                try:
+                    if shell:
+                        proc = await asyncio.create_subprocess_shell(
+                            subprocess.list2cmdline(cmd), stdout=subprocess.PIPE)
+                    else:
+                        proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE)
+                except NotImplementedError:
+                    # The event loop cannot run subprocesses, as the selector
+                    # loop on Windows: run the blocking call in the executor
+                    attributes['mode'] = 'executor'
+                    out = await asyncio.get_event_loop().run_in_executor(
+                        None, self._check_conda_output, cmd, shell)
+                else:
+                    try:
+                        out, _ = await asyncio.wait_for(proc.communicate(), self.conda_timeout)
+                    except asyncio.TimeoutError:
+                        proc.kill()
+                        await proc.wait()
+                        raise subprocess.TimeoutExpired(cmd, self.conda_timeout)
+                    if proc.returncode:
+                        raise subprocess.CalledProcessError(proc.returncode, cmd, out)
+                conda_info, err = json.loads(out), None
+                attributes['env_count'] = len(conda_info.get('envs') or ())
+            except Exception as exc:
+                conda_info, err = None, exc
+                attributes['error'] = str(exc)
+        CONDA_INFO_DURATION_SECONDS.observe(attributes['duration'])
+        self._store_conda_info(conda_info, err, fingerprint=fingerprint)
+
+    async def _async_conda_info(self):
+        """ Asynchronous counterpart of _conda_info, which never blocks the
+            event loop. Only the very first call waits for conda; later
+            refreshes run in the background while the cache is returned,
+            also by _conda_info, which then does not run conda itself.
+        """
+        expiry = self._conda_info_cache_expiry
+        if expiry is not None and expiry >= time.time():
+            return self._conda_info_cache
+        if self._conda_info_cache_thread is not None:
+            # A refresh started by _conda_info is running or ready to collect
+            return self._conda_info
+        task = self._conda_info_task
+        if task is None or task.done():
+            task = self._conda_info_task = asyncio.ensure_future(self._async_refresh_conda_info())
+        if expiry is None:
+            await task
+        return self._conda_info_cache
+
+    async def _run_in_executor(self, func, *args):
+        """ Run a discovery method in the default executor, once conda info
+            is available, so that the filesystem is never scanned on the
+            event loop.
+        """
+        await self._async_conda_info()
+        loop = self._event_loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    def _conda_info_key(self):
+        """ Fingerprint of the inputs that determine the environments listed
+            by `conda info`: the environments.txt files, the condarc files,
+            the envs directories, and the variables that override them. The
+            paths of the last conda info result are used, so the first
+            fingerprint is only partial and never matches a later one.
+        """
+        conda_info = self._conda_info_cache or {}
+        paths = [join(os.path.expanduser('~'), '.conda', 'environments.txt')]
+        if conda_info.get('root_prefix'):
+            paths.append(join(conda_info['root_prefix'], '.conda', 'environments.txt'))
+        paths.extend(conda_info.get('config_files') or ())
+        paths.extend(conda_info[key] for key in ('user_rc_path', 'sys_rc_path') if conda_info.get(key))
+        paths.extend(conda_info.get('envs_dirs') or ())
+        key = [os.environ.get(var) for var in ('CONDARC', 'CONDA_ENVS_PATH', 'CONDA_ENVS_DIRS')]
+        for path in paths:
+            try:
+                st = os.stat(path)
+                key.append((path, st.st_mtime_ns, st.st_size))
+            except OSError:
+                key.append((path, None))
+        return tuple(key)
+
+    def _store_conda_info(self, conda_info, err, fingerprint=None):
+        """ Record the outcome of a conda info call.
+
+            On success, the result is cached, along with the fingerprint of
+            the conda configuration it was computed from, according to the
+            conda_info_cache_timeout and adaptive_cache_timeout options, and
+            saved to conda_info_file if set. On failure, the last successful
+            result is kept---loading it from conda_info_file if there is none
+            in memory---and the call is retried after a delay that doubles
+            with each consecutive failure.
+        """
+        if conda_info is not None:
+            self._conda_info_failures = 0
+            self._conda_info_fingerprint = fingerprint
+            changed = conda_info != self._conda_info_cache
+            if changed:
+                self._write_conda_info_file(conda_info)
+            if self._conda_info_cache is None:
+                self._conda_info_ttl = self.conda_info_cache_timeout
+            else:
+                self._conda_info_ttl = self._next_cache_timeout(
+                    'conda info', self._conda_info_ttl, self.conda_info_cache_timeout, changed)
+            self._conda_info_cache = conda_info
+            self._conda_info_cache_expiry = time.time() + self._conda_info_ttl
+            return
+
+        self._conda_info_failures += 1
+        CONDA_INFO_FAILURES.inc()
+        delay = min(RETRY_DELAY * 2 ** (self._conda_info_failures - 1), MAX_RETRY_DELAY)
+        if self._conda_info_cache is None:
+            self._conda_info_cache = self._read_conda_info_file()
+        self.log.error("nb_conda_kernels | couldn't call conda (retrying in %s seconds%s):\n%s",
+                       delay, "" if self._conda_info_cache is None else ", using its last output", err)
+        self._conda_info_cache_expiry = time.time() + delay
+
+    def _read_conda_info_file(self):
+        if not self.conda_info_file or not os.path.exists(self.conda_info_file):
+            return None
+        try:
+            with open(self.conda_info_file, 'rb') as fp:
+                return json.loads(fp.read().decode('utf-8'))
+        except Exception as err:
+            self.log.warning("nb_conda_kernels | couldn't read %s:\n%s", self.conda_info_file, err)
+            return None
+
+    def _write_conda_info_file(self, conda_info):
+        if not self.conda_info_file:
+            return
+        # Write to a temporary file first, so that readers never see a partial file
+        tmp_file = '{}.{}.tmp'.format(self.conda_info_file, os.getpid())
+        try:
+            with open(tmp_file, 'w') as fp:
+                json.dump(conda_info, fp)
+            os.replace(tmp_file, self.conda_info_file)
+        except OSError as err:
+            self.log.warning("nb_conda_kernels | couldn't write %s:\n%s", self.conda_info_file, err)
+
+    def _unique_envs(self, envs, base_prefix, stat=None):
+        """ Keep a single path for each physical environment, identified
+            by the device and inode of its directory, and chosen according
+            to env_path_preference. The order of first appearance is kept.
+        """
+        groups = OrderedDict()
+        for env_path in envs:
+            try:
+                st = (stat or os.stat)(env_path)
+                key = (st.st_dev, st.st_ino)
+            except OSError:
+                key = env_path
+            groups.setdefault(key, []).append(env_path)
+        unique = []
+        for paths in groups.values():
+            if len(paths) == 1:
+                env_path = paths[0]
+            elif base_prefix in paths:
+                env_path = base_prefix
+            elif self.env_path_preference == 'shortest':
+                env_path = min(paths, key=len)
+            elif self.env_path_preference == 'realpath':
+                env_path = self._canonicalize(os.path.realpath(paths[0]))
+            else:
+                env_path = paths[0]
+            if len(paths) > 1:
+                self.log.debug("nb_conda_kernels | Using %s for environment paths %s",
+                               env_path, ', '.join(paths))
+            unique.append(env_path)
+        return unique
+
     def _all_envs(self):
         """ Find all of the environments we should be checking. We skip
             environments in the conda-bld directory. Returns a dict with
             canonical environment names as keys, and full paths as values.
         """
         conda_info = self._conda_info
-        envs = list(map(_canonicalize, conda_info['envs']))
-        base_prefix = _canonicalize(conda_info['conda_prefix'])
+        # Select the environments on their path before any other work on them
+        matcher = self._env_matcher
+        envs = [env_path for env_path in conda_info['envs'] if matcher.match_path(env_path)]
+        stat = self._stat_envs(envs + [conda_info['conda_prefix']])
+        envs = [self._canonicalize(env_path, stat) for env_path in envs if matcher(env_path, stat)]
+        base_prefix = self._canonicalize(conda_info['conda_prefix'], stat)
         envs_prefix = join(base_prefix, 'envs')
         build_prefix = join(base_prefix, 'conda-bld', '')
         # Older versions of conda do not seem to include the base prefix
         # in the environment list, but we do want to scan that
-        if base_prefix not in envs:
+        if base_prefix not in envs and matcher(base_prefix, stat):
             envs.insert(0, base_prefix)
         envs_dirs = conda_info['envs_dirs']
         if not envs_dirs:
             envs_dirs = [join(base_prefix, 'envs')]
+        if self.env_path_preference is not None:
+            envs = self._unique_envs(envs, base_prefix, stat)
         all_envs = {}
+        # The next counter to try for each name that needed disambiguation
+        counters = {}
         for env_path in envs:
-            if self.env_filter and self._env_filter_regex.search(env_path):
-                continue
-            elif env_path == base_prefix:
+            if env_path == base_prefix:
                 env_name = self.base_name
             elif env_path.startswith(build_prefix):
                 # Skip the conda-bld directory entirely
@@ -240,99 +942,306 @@ class CondaKernelSpecManager(KernelSpecManager):
                 # of the parent directory, then, provides useful context.
                 if basename(env_base) == 'envs' and (env_base != envs_prefix or env_name in all_envs):
                     env_name = u'{}-{}'.format(basename(dirname(env_base)), env_name)
-            # Further disambiguate, if necessary, with a counter.
+            # Further disambiguate, if necessary, with a counter. Names are
+            # never removed, so every counter below the recorded one is taken.
             if env_name in all_envs:
                 base_name = env_name
-                for count in range(len(all_envs)):
-                    env_name = u'{}-{}'.format(base_name, count + 2)
-                    if env_name not in all_envs:
-                        break
+                count = counters.get(base_name, 2)
+                env_name = u'{}-{}'.format(base_name, count)
+                while env_name in all_envs:
+                    count += 1
+                    env_name = u'{}-{}'.format(base_name, count)
+                counters[base_name] = count + 1
             all_envs[env_name] = env_path
         return all_envs
 
-    def _all_specs(self):
-        """ Find the all kernel specs in all environments.
+    def _conda_kernel_name(self, env_name, raw_kernel_name):
+        """ Build the Jupyter kernel name of a kernel found in an environment.
+        """
+        kernel_name = raw_kernel_name
+        # We're doing a few of these adjustments here to ensure that
+        # the naming convention is as close as possible to the previous
+        # versions of this package; particularly so that the tests
+        # pass without change.
+        if kernel_name in ('python2', 'python3'):
+            kernel_name = 'py'
+        elif kernel_name == 'ir':
+            kernel_name = 'r'
+        kernel_prefix = '' if env_name == self.base_name else 'env-'
+        kernel_name = u'conda-{}{}-{}'.format(kernel_prefix, env_name, kernel_name)
+        # Replace invalid characters with dashes
+        return self.clean_kernel_name(kernel_name)
 
-            Returns a dict with unique env names as keys, and the kernel.json
-            content as values, modified so that they can be run properly in
-            their native environments.
+    def _load_kernel(self, kernel):
+        """ Read the kernel.json of a conda kernel on first use, and modify
+            it so that it can be run properly in its native environment.
+            Returns the kernel, or None if its kernel.json cannot be loaded.
 
-            Caches the information for CACHE_TIMEOUT seconds, as this is
-            relatively expensive.
+            The kernel is only marked as loaded once all of its fields are
+            set, so a concurrent reader either sees them all, or loads the
+            same values itself.
         """
+        if kernel.loaded:
+            return None if kernel.argv is None else kernel
+        spec_path = join(kernel.resource_dir, 'kernel.json')
+        try:
+            with open(spec_path, 'rb') as fp:
+                st = os.fstat(fp.fileno())
+                data = fp.read()
+            spec = json.loads(data.decode('utf-8'))
+            argv = _intern_all(spec.pop('argv'))
+            display_name = spec.pop('display_name')
+        except Exception as err:
+            self.log.error("nb_conda_kernels | error loading %s:\n%s",
+                           spec_path, err)
+            kernel.loaded = True
+            return None
+        env = kernel.env
 
-        all_specs = {}
+        display_prefix = display_name
+        if display_prefix.startswith('Python'):
+            display_prefix = 'Python'
+        display_name = self.name_format.format(
+            display_prefix,
+            env.name,
+            conda_kernel=kernel.name,
+            display_name=display_name,
+            environment=env.name,
+            kernel=kernel.raw_name,
+            language=display_prefix,
+        )
+        if env.is_current:
+            display_name += ' *'
+        kernel.display_name = display_name
+        kernel.display_prefix = sys.intern(display_prefix)
+        kernel.language = spec.pop('language', None)
+        kernel.variables = spec.pop('env', None)
+        kernel.interrupt_mode = spec.pop('interrupt_mode', None)
+        if isinstance(kernel.language, str):
+            kernel.language = sys.intern(kernel.language)
+        metadata = spec.pop('metadata', None) or {}
+        if self.enable_debugger is not None:
+            metadata.update({"debugger": self.enable_debugger})
+        kernel.metadata = metadata or None
+        kernel.extra = spec or None
+        kernel.fingerprint = (st.st_mtime_ns, st.st_size)
+        kernel.argv = argv
+        kernel.loaded = True
+        return kernel
+
+    @property
+    def _allowed_kernelspecs(self):
+        """ The allow list of kernel names, from the allowed_kernelspecs
+            option of jupyter_client or its older name whitelist.
+        """
+        return getattr(self, 'allowed_kernelspecs', None) or getattr(self, 'whitelist', None)
+
+    @staticmethod
+    def _scan_env(env_path):
+        """ List the kernel directories of an environment.
+        """
+        kspec_base = join(env_path, 'share', 'jupyter', 'kernels')
+        return [dirname(spec_path) for spec_path in glob.glob(join(kspec_base, '*', 'kernel.json'))]
+
+    def _traced_scan_env(self, env_path):
+        with self._trace('scan_env', env_path=env_path) as attributes:
+            kernel_dirs = self._scan_env(env_path)
+            attributes['kernel_count'] = len(kernel_dirs)
+        return kernel_dirs
+
+    def _submit_scans(self, fn, paths, pending):
+        """ Submit fn for each path to the scan pool, reusing the unfinished
+            futures of the given dict, and wait for them with _wait_scans.
+            Returns the futures done, and those still pending, in two dicts
+            keyed by path.
+        """
+        if self._scan_pool is None:
+            self._scan_pool = _ScanPool()
+        futures = {}
+        for path in paths:
+            future = pending.get(path)
+            if future is None:
+                future = self._scan_pool.submit(fn, path)
+            futures[path] = future
+        self._wait_scans(futures.values())
+        done = {path: future for path, future in futures.items() if future.done()}
+        pending = {path: future for path, future in futures.items() if not future.done()}
+        return done, pending
+
+    def _stat_envs(self, env_paths):
+        """ Stat the given environment paths. Returns a function with the
+            signature of os.stat, which only accepts these paths.
+
+            If env_scan_timeout is set, the stats are run in the scan pool,
+            like the scans, and an environment whose stat does not complete
+            in time, e.g. on an unresponsive network mount, is handled as
+            if it could not be stat'd: it is neither deduplicated nor
+            canonicalized, and excluded by env_owner_only.
+        """
+        if self.env_scan_timeout is None:
+            return os.stat
+        done, self._pending_stats = self._submit_scans(_stat_env, env_paths, self._pending_stats)
+        for env_path in self._pending_stats:
+            self.log.debug("nb_conda_kernels | %s does not respond after %s seconds",
+                           env_path, self.env_scan_timeout)
+
+        def stat(path):
+            future = done.get(path)
+            if future is None:
+                raise OSError("{} is not available".format(path))
+            return future.result()
+
+        return stat
+
+    def _wait_scans(self, futures):
+        """ Wait for futures of the scan pool until each one is done, or
+            has been running for env_scan_timeout seconds. A queued scan
+            waits for its start, so its deadline is not shortened by the
+            scans before it.
+        """
+        timeout = self.env_scan_timeout
+        futures = list(futures)
+        while True:
+            now = time.time()
+            futures = [f for f in futures
+                       if not f.done() and (f.started is None or now < f.started + timeout)]
+            if not futures:
+                return
+            if any(f.started is None for f in futures):
+                self._scan_pool.replace_stuck(timeout)
+            deadlines = [f.started + timeout for f in futures if f.started is not None]
+            wait(futures, timeout=min(deadlines) - now if deadlines else timeout)
+
+    def _scan_envs(self, env_paths):
+        """ List the kernel directories of the given environments. Returns
+            a dict with environment paths as keys, and lists of kernel
+            directories as values.
+
+            If env_scan_timeout is set, the environments are scanned
+            concurrently, and those not done in time are served from their
+            last known scan, or omitted. Their scan goes on in the
+            background, and its result is used by the next refresh.
+        """
+        if self.env_scan_timeout is None:
+            return {env_path: self._traced_scan_env(env_path) for env_path in env_paths}
+
+        done, pending_scans = self._submit_scans(self._traced_scan_env, env_paths, self._pending_scans)
+        env_scans = {}
+        for env_path, future in done.items():
+            try:
+                env_scans[env_path] = future.result()
+            except Exception as err:
+                self.log.error("nb_conda_kernels | error scanning %s:\n%s", env_path, err)
+        for env_path in pending_scans:
+            last_scan = self._env_scans.get(env_path)
+            self.log.warning(
+                "nb_conda_kernels | scanning %s takes more than %s seconds; %s",
+                env_path, self.env_scan_timeout,
+                "omitting it" if last_scan is None else "using its last known kernels")
+            if last_scan is not None:
+                env_scans[env_path] = last_scan
+        # Only remember the environments that are still listed
+        self._env_scans = env_scans
+        self._pending_scans = pending_scans
+        return env_scans
+
+    def _language_allowed(self, kernel, languages):
+        """ Whether a conda kernel declares one of the given lowercase
+            languages, which requires loading its kernel.json.
+        """
+        if self._load_kernel(kernel) is None:
+            return False
+        return isinstance(kernel.language, str) and kernel.language.lower() in languages
+
+    def _kernel_allowed(self, kernel):
+        """ Whether a conda kernel passes the allow list and allowed_languages.
+        """
+        allow = self._allowed_kernelspecs
+        if allow and kernel.name not in allow:
+            return False
+        languages = set(lang.lower() for lang in self.allowed_languages)
+        return not languages or self._language_allowed(kernel, languages)
+
+    def _all_kernels(self, envs=None, filters=True):
+        """ Find the all kernels in all environments, or in the given dict
+            of environments, without reading their kernel.json files unless
+            allowed_languages is set. If filters is False, the allow list
+            and allowed_languages are not applied.
+
+            Returns a dict with unique kernel names as keys, and
+            _CondaKernel records as values.
+        """
+        all_kernels = {}
         # We need to be able to find conda-run in the base conda environment
         # even if this package is not running there
         conda_prefix = self._conda_info['conda_prefix']
-        all_envs = self._all_envs()
-        for env_name, env_path in all_envs.items():
-            kspec_base = join(env_path, 'share', 'jupyter', 'kernels')
-            kspec_glob = glob.glob(join(kspec_base, '*', 'kernel.json'))
-            for spec_path in kspec_glob:
-                try:
-                    with open(spec_path, 'rb') as fp:
-                        data = fp.read()
-                    spec = json.loads(data.decode('utf-8'))
-                except Exception as err:
-                    self.log.error("nb_conda_kernels | error loading %s:\n%s",
-                                   spec_path, err)
+        # Apply the filters as early as possible: the allow list to the
+        # environments and then to the kernel names, before reading any
+        # kernel.json; the languages, which are only known from the
+        # kernel.json, last.
+        allow = self._allowed_kernelspecs if filters else None
+        languages = set(lang.lower() for lang in self.allowed_languages) if filters else ()
+        if envs is None:
+            envs = self._all_envs()
+        all_envs = {}
+        for env_name, env_path in envs.items():
+            if allow:
+                is_base = env_name == self.base_name
+                name_prefix = self.clean_kernel_name(
+                    u'conda-{}{}-'.format('' if is_base else 'env-', env_name))
+                if not any(name.startswith(name_prefix) for name in allow):
                     continue
-                kernel_dir = dirname(spec_path)
-                kernel_name = raw_kernel_name = basename(kernel_dir)
-                if self.kernelspec_path is not None and kernel_name.startswith("conda-"):
-                    self.log.debug("nb_conda_kernels | Skipping kernel spec %s", spec_path)
+            all_envs[env_name] = env_path
+        ENVS_SCANNED.inc(len(all_envs))
+        env_scans = self._scan_envs(all_envs.values())
+        for env_name, env_path in all_envs.items():
+            env = None
+            for kernel_dir in env_scans.get(env_path, ()):
+                raw_kernel_name = basename(kernel_dir)
+                if self.kernelspec_path is not None and raw_kernel_name.startswith("conda-"):
+                    self.log.debug("nb_conda_kernels | Skipping kernel spec %s", kernel_dir)
                     continue  # Ensure to skip dynamically added kernel spec within the environment prefix
-                # We're doing a few of these adjustments here to ensure that
-                # the naming convention is as close as possible to the previous
-                # versions of this package; particularly so that the tests
-                # pass without change.
-                if kernel_name in ('python2', 'python3'):
-                    kernel_name = 'py'
-                elif kernel_name == 'ir':
-                    kernel_name = 'r'
-                is_base = env_name == self.base_name
-                kernel_prefix = '' if is_base else 'env-'
-                kernel_name = u'conda-{}{}-{}'.format(kernel_prefix, env_name, kernel_name)
-                # Replace invalid characters with dashes
-                kernel_name = self.clean_kernel_name(kernel_name)
-
-                display_prefix = spec['display_name']
-                if display_prefix.startswith('Python'):
-                    display_prefix = 'Python'
-                display_name = self.name_format.format(
-                    display_prefix,
-                    env_name,
-                    conda_kernel=kernel_name,
-                    display_name=spec['display_name'],
-                    environment=env_name,
-                    kernel=raw_kernel_name,
-                    language=display_prefix,
-                )
-                is_current = env_path == sys.prefix
-                if is_current:
-                    display_name += ' *'
-                spec['display_name'] = display_name
-                if env_path != sys.prefix:
-                    spec['argv'] = RUNNER_COMMAND + [conda_prefix, env_path] + spec['argv']
-                metadata = spec.get('metadata', {})
-                metadata.update({
-                    'conda_env_name': env_name,
-                    'conda_env_path': env_path,
-                    'conda_language': display_prefix,
-                    'conda_raw_kernel_name': raw_kernel_name,
-                    'conda_is_base_environment': is_base,
-                    'conda_is_currently_running': is_current
-                })
-                if self.enable_debugger is not None:
-                    metadata.update({"debugger": self.enable_debugger})
-                spec['metadata'] = metadata
-
-                if self.kernelspec_path is not None:
-                    # Install the kernel spec
+                kernel_name = self._conda_kernel_name(env_name, raw_kernel_name)
+                if allow and kernel_name not in allow:
+                    continue
+                if env is None:
+                    env = _CondaEnv(env_name, env_path, env_name == self.base_name, conda_prefix)
+                kernel = _CondaKernel(kernel_name, env, kernel_dir)
+                if languages and not self._language_allowed(kernel, languages):
+                    continue
+                all_kernels[kernel_name] = kernel
+        return all_kernels
+
+    def _all_specs(self, kernels=None):
+        """ Find the all kernel specs in all environments, or only in the
+            given dict of _CondaKernel records.
+
+            Returns a dict with unique env names as keys, and the kernel.json
+            content as values, modified so that they can be run properly in
+            their native environments.
+
+            If kernelspec_path is set, the kernel specs are installed there
+            as well, and the stale ones are removed; so the kernels given
+            must not be filtered by the allow list or allowed_languages, or
+            the specs of the others would be removed.
+        """
+
+        all_specs = {}
+        if kernels is None:
+            kernels = self._all_kernels(filters=self.kernelspec_path is None)
+        for kernel_name, kernel in kernels.items():
+            if self._load_kernel(kernel) is None:
+                continue
+            spec = kernel.to_json()
+            env = kernel.env
+
+            if self.kernelspec_path is not None:
+                # Install the kernel spec
+                with self._trace('install_kernelspec', kernel_name=kernel_name,
+                                 env_path=env.path) as attributes:
                     try:
                         destination = self.install_kernel_spec(
-                            kernel_dir,
+                            kernel.resource_dir,
                             kernel_name=kernel_name,
                             user=self._kernel_user,
                             prefix=self._kernel_prefix
@@ -340,20 +1249,22 @@ class CondaKernelSpecManager(KernelSpecManager):
                         # Update the kernel spec
                         kernel_spec = join(destination, "kernel.json")
                         tmp_spec = spec.copy()
-                        if env_path == sys.prefix:  # Add the conda runner to the installed kernel spec
-                            tmp_spec['argv'] = RUNNER_COMMAND + [conda_prefix, env_path] + spec['argv']
+                        if env.is_current:  # Add the conda runner to the installed kernel spec
+                            conda_prefix = self._conda_info['conda_prefix']
+                            tmp_spec['argv'] = RUNNER_COMMAND + [conda_prefix, env.path] + spec['argv']
                         with open(kernel_spec, "w") as f:
                             json.dump(tmp_spec, f)
+                        KERNELSPECS_WRITTEN.inc()
                     except OSError as error:
+                        attributes['error'] = str(error)
                         self.log.warning(
-                            u"nb_conda_kernels | Fail to install kernel '{}'.".format(kernel_dir),
+                            u"nb_conda_kernels | Fail to install kernel '{}'.".format(kernel.resource_dir),
                             exc_info=error
                         )
 
-                # resource_dir is not part of the spec file, so it is added at the latest time
-                spec['resource_dir'] = abspath(kernel_dir)
-
-                all_specs[kernel_name] = spec
+            # resource_dir is not part of the spec file, so it is added at the latest time
+            spec['resource_dir'] = kernel.resource_dir
+            all_specs[kernel_name] = spec
 
         # Remove non-existing conda environments
         if self.kernelspec_path is not None:
@@ -362,60 +1273,317 @@ class CondaKernelSpecManager(KernelSpecManager):
                 user=self._kernel_user,
                 prefix=self._kernel_prefix
             )
-            for folder in glob.glob(join(kernels_destination, "*", "kernel.json")):
-                kernel_dir = dirname(folder)
-                kernel_name = basename(kernel_dir)
-                if kernel_name.startswith("conda-") and kernel_name not in all_specs:
-                    self.log.info("Removing %s", kernel_dir)
-                    if os.path.islink(kernel_dir):
-                        os.remove(kernel_dir)
-                    else:
-                        shutil.rmtree(kernel_dir)
+            with self._trace('remove_stale_kernelspecs', path=kernels_destination) as attributes:
+                attributes['removed_count'] = 0
+                for folder in glob.glob(join(kernels_destination, "*", "kernel.json")):
+                    kernel_dir = dirname(folder)
+                    kernel_name = basename(kernel_dir)
+                    if kernel_name.startswith("conda-") and kernel_name not in all_specs:
+                        self.log.info("Removing %s", kernel_dir)
+                        if os.path.islink(kernel_dir):
+                            os.remove(kernel_dir)
+                        else:
+                            shutil.rmtree(kernel_dir)
+                        attributes['removed_count'] += 1
 
         return all_specs
 
+    def _conda_snapshot(self):
+        """ Get the current _Snapshot, or publish a new one if it has
+            expired. Only one thread refreshes it at a time; the others
+            keep using the previous snapshot meanwhile, and only wait for
+            the refresh if there is none yet. Returns None if conda info
+            is unavailable.
+
+            The kernel specs are loaded on demand by _load_kernel, unless
+            they all need to be installed to kernelspec_path anyway.
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and not snapshot.expired():
+            CACHE_REQUESTS.labels('conda_kernels', 'hit').inc()
+            return snapshot
+
+        conda_info = self._conda_info
+        if conda_info is None:
+            return None
+        CACHE_REQUESTS.labels('conda_kernels', 'miss').inc()
+
+        if not self._snapshot_lock.acquire(snapshot is None):
+            return snapshot
+        try:
+            if self._snapshot is not snapshot:
+                # Published by another thread in the meantime
+                return self._snapshot
+            snapshot, changes, duration = self._traced_refresh(snapshot, conda_info)
+        finally:
+            self._snapshot_lock.release()
+        self._notify_changes(snapshot, changes, duration)
+        return snapshot
+
+    def _refresh_now(self):
+        """ Publish a new _Snapshot, whether the current one has expired
+            or not. Unlike _conda_snapshot, waits for a refresh in progress
+            rather than using its result, which may predate the request.
+            Returns the new generation.
+        """
+        conda_info = self._conda_info
+        if conda_info is None:
+            return self.generation
+        with self._snapshot_lock:
+            snapshot, changes, duration = self._traced_refresh(self._snapshot, conda_info)
+        self._notify_changes(snapshot, changes, duration)
+        return snapshot.generation
+
+    def _traced_refresh(self, snapshot, conda_info):
+        """ Trace _refresh_snapshot, with _snapshot_lock held by the caller.
+            Returns the new snapshot, the change set, and the duration.
+        """
+        with self._trace('refresh') as attributes:
+            snapshot, changes = self._refresh_snapshot(snapshot, conda_info)
+            attributes.update(generation=snapshot.generation, changed=changes is not None,
+                              kernel_count=len(snapshot.kernels), env_count=len(snapshot.envs))
+        return snapshot, changes, attributes['duration']
+
+    def _notify_changes(self, snapshot, changes, duration):
+        """ Notify the observers of a change set, once its snapshot is
+            published.
+        """
+        if changes is not None:
+            self.kernel_changes = changes
+            event = dict(changes, duration=duration,
+                         kernel_count=len(snapshot.kernels), env_count=len(snapshot.envs))
+            self._emit_event(event)
+
+    def _emit_event(self, data):
+        """ Emit a change of the conda kernels to the event logger, if any.
+            The event listeners of jupyter_events are asyncio tasks, so the
+            event is handed over to the event loop when emitted from another
+            thread, such as the executor of the async API.
+        """
+        logger = self.event_logger or getattr(self.parent, 'event_logger', None)
+        if logger is None:
+            return
+        try:
+            if EVENT_SCHEMA_ID not in logger.schemas:
+                logger.register_event_schema(EVENT_SCHEMA_PATH)
+            loop = self._event_loop
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                if loop is not None and loop.is_running():
+                    loop.call_soon_threadsafe(self._emit, logger, data)
+                    return
+            self._emit(logger, data)
+        except Exception as err:
+            self.log.warning("nb_conda_kernels | couldn't emit the kernel changes:\n%s", err)
+
+    def _emit(self, logger, data):
+        try:
+            logger.emit(schema_id=EVENT_SCHEMA_ID, data=data)
+        except Exception as err:
+            self.log.warning("nb_conda_kernels | couldn't emit the kernel changes:\n%s", err)
+
+    def _refresh_snapshot(self, snapshot, conda_info):
+        """ Discover the conda kernels, and publish them as the snapshot
+            following the given one, if any. Returns the new snapshot, and
+            its change set, or None if the kernels are unchanged.
+        """
+        with self._trace('all_envs') as attributes:
+            envs = self._all_envs()
+            attributes['env_count'] = len(envs)
+        DISCOVERY_DURATION_SECONDS.labels('envs').observe(attributes['duration'])
+        # Every conda kernel is installed to kernelspec_path, whatever the
+        # allow list and allowed_languages, which then only apply to the listing
+        install = self.kernelspec_path is not None
+        with self._trace('all_kernels', env_count=len(envs)) as attributes:
+            kspecs = self._all_kernels(envs, filters=not install)
+            attributes['kernel_count'] = len(kspecs)
+        DISCOVERY_DURATION_SECONDS.labels('kernels').observe(attributes['duration'])
+        if install:
+            with self._trace('all_specs', kernel_count=len(kspecs)) as attributes:
+                self._all_specs(kspecs)
+            DISCOVERY_DURATION_SECONDS.labels('specs').observe(attributes['duration'])
+            kspecs = {name: kernel for name, kernel in kspecs.items() if self._kernel_allowed(kernel)}
+        CONDA_KERNELS.set(len(kspecs))
+
+        old_dirs = {} if snapshot is None else {k: v.resource_dir for k, v in snapshot.kernels.items()}
+        new_dirs = {k: v.resource_dir for k, v in kspecs.items()}
+        changed = snapshot is None or new_dirs != old_dirs
+        if snapshot is None:
+            self._conda_kernels_ttl = self.kernels_cache_timeout
+        else:
+            self._conda_kernels_ttl = self._next_cache_timeout(
+                'conda kernels', self._conda_kernels_ttl, self.kernels_cache_timeout, changed)
+        generation = (0 if snapshot is None else snapshot.generation) + changed
+        changes = None
+        if changed:
+            changes = {
+                'generation': generation,
+                'added': sorted(new_dirs.keys() - old_dirs.keys()),
+                'removed': sorted(old_dirs.keys() - new_dirs.keys()),
+                'changed': sorted(k for k in new_dirs.keys() & old_dirs.keys() if new_dirs[k] != old_dirs[k]),
+            }
+            self._changes.append(changes)
+
+        projection = {}
+        for key in SNAPSHOT_CONDA_INFO:
+            value = conda_info.get(key)
+            projection[key] = tuple(value) if isinstance(value, list) else value
+        now = time.time()
+        self._snapshot = _Snapshot(
+            generation=generation,
+            timestamp=now,
+            expiry=now + self._conda_kernels_ttl,
+            conda_info=MappingProxyType(projection),
+            envs=MappingProxyType(dict(envs)),
+            kernels=MappingProxyType(kspecs)
+        )
+        return self._snapshot, changes
+
+    def changes_since(self, generation):
+        """ Returns the changes to the conda kernels since the given
+            generation, refreshing them if needed, in the same form as
+            kernel_changes. Returns None if that generation is too old
+            to be known, or newer than the current one, e.g. from before a
+            restart; the caller then needs to list all the kernels.
+        """
+        current = self.generation
+        result = {'generation': current, 'added': [], 'removed': [], 'changed': []}
+        if generation == current:
+            return result
+        if generation > current:
+            return None
+        changes = [c for c in list(self._changes) if c['generation'] > generation]
+        if not changes or changes[0]['generation'] != generation + 1:
+            return None
+        # Combine the successive change sets, kernel by kernel
+        states = {}
+        for change in changes:
+            for name in change['added']:
+                states[name] = 'changed' if states.get(name) == 'removed' else 'added'
+            for name in change['removed']:
+                if states.get(name) == 'added':
+                    del states[name]
+                else:
+                    states[name] = 'removed'
+            for name in change['changed']:
+                if states.get(name) != 'added':
+                    states[name] = 'changed'
+        for name, state in sorted(states.items()):
+            result[state].append(name)
+        return result
+
     @property
     def _conda_kspecs(self):
-        """ Get (or refresh) the cache of conda kernels
+        """ Get (or refresh) the conda kernels, as a read-only dict mapping
+            kernel names to _CondaKernel records, from the current snapshot.
         """
-        if self._conda_info is None:
-            return {}
+        snapshot = self._conda_snapshot()
+        return {} if snapshot is None else snapshot.kernels
 
-        expiry = self._conda_kernels_cache_expiry
-        if expiry is not None and expiry >= time.time():
-            return self._conda_kernels_cache
+    @property
+    def generation(self):
+        """ The generation of the conda kernels, refreshed if needed. It is
+            incremented each time a refresh finds a different set of kernels,
+            and is 0 until conda info is available.
+        """
+        snapshot = self._conda_snapshot()
+        return 0 if snapshot is None else snapshot.generation
+
+    def _native_kspecs_key(self):
+        """ Fingerprint of everything the standard Jupyter kernel search
+            depends on. Adding or removing a kernel spec directory updates
+            the modification time of its parent, so a stat of each entry
+            of kernel_dirs is enough to detect a change without listing.
+        """
+        key = [self.ensure_native_kernel, tuple(sorted(self._allowed_kernelspecs or ()))]
+        for kernel_dir in self.kernel_dirs:
+            try:
+                key.append((kernel_dir, os.stat(kernel_dir).st_mtime_ns))
+            except OSError:
+                key.append((kernel_dir, None))
+        return tuple(key)
+
+    @property
+    def _native_kspecs(self):
+        """ Get (or refresh) the cache of the kernels found by the standard
+            Jupyter search, with canonicalized resource directories.
+
+            The cache is invalidated when the kernel directories change,
+            and in any case after kernels_cache_timeout seconds, since a kernel.json
+            written into an existing directory does not touch its parent.
+        """
+        key = self._native_kspecs_key()
+        cache = self._native_kernels_cache
+        if cache is not None and cache[0] == key and cache[1] >= time.time():
+            CACHE_REQUESTS.labels('native_kernels', 'hit').inc()
+            return cache[2]
+        CACHE_REQUESTS.labels('native_kernels', 'miss').inc()
 
-        kspecs = {}
-        for name, info in self._all_specs().items():
-            kspecs[name] = KernelSpec(**info)
+        kspecs = super(CondaKernelSpecManager, self).find_kernel_specs()
+        kspecs = {k: self._canonicalize(v) for k, v in kspecs.items()}
 
-        self._conda_kernels_cache_expiry = time.time() + CACHE_TIMEOUT
-        self._conda_kernels_cache = kspecs
+        self._native_kernels_cache = (key, time.time() + self.kernels_cache_timeout, kspecs)
 
         return kspecs
 
-    def find_kernel_specs(self):
-        """ Returns a dict mapping kernel names to resource directories.
+    def _merge_kspecs(self, conda_kspecs):
+        """ Merge the conda kernels with the standard Jupyter kernels and
+            apply the allow list. Returns a dict mapping kernel names to
+            resource directories.
 
-            The update process also adds the resource dir for the conda
-            environments.
+            The conda kernels whose kernel.json is known to be invalid are
+            left out, since get_kernel_spec cannot return them.
         """
         if self.conda_only:
             kspecs = {}
         else:
-            kspecs = super(CondaKernelSpecManager, self).find_kernel_specs()
-            kspecs = {k: _canonicalize(v) for k, v in kspecs.items()}
+            kspecs = dict(self._native_kspecs)
         spec_rev = {v: k for k, v in kspecs.items()}
-        for name, spec in self._conda_kspecs.items():
-            kspecs[name] = spec.resource_dir
+        for name, kernel in conda_kspecs.items():
+            if kernel.loaded and kernel.argv is None:
+                continue
+            kspecs[name] = kernel.resource_dir
             dup = spec_rev.get(kspecs[name])
             if dup:
                 del kspecs[dup]
-        allow = getattr(self, 'allowed_kernelspecs', None) or getattr(self, 'whitelist', None)
+        allow = self._allowed_kernelspecs
         if allow:
             kspecs = {k: v for k, v in kspecs.items() if k in allow}
         return kspecs
 
+    def find_kernel_specs(self):
+        """ Returns a dict mapping kernel names to resource directories.
+
+            The update process also adds the resource dir for the conda
+            environments.
+        """
+        return self._merge_kspecs(self._conda_kspecs)
+
+    def _conda_kspec(self, kernel_name):
+        """ Get a single conda kernel. If the cache has expired, only the
+            kernel.json of that kernel is read again, from the location
+            found by the last full scan; the full scan is left to the next
+            listing of the kernels.
+        """
+        if self._conda_info is None:
+            return None
+
+        snapshot = self._snapshot
+        if snapshot is not None and not snapshot.expired():
+            kernel = snapshot.kernels.get(kernel_name)
+            return None if kernel is None else self._load_kernel(kernel)
+
+        kernel = None if snapshot is None else snapshot.kernels.get(kernel_name)
+        if kernel is not None:
+            # The snapshot is left as is: read the kernel.json into a new record
+            kernel = _CondaKernel(kernel.name, kernel.env, kernel.resource_dir)
+            if self._load_kernel(kernel) is not None:
+                return kernel
+        # Unknown or vanished kernel: fall back on a full scan
+        kernel = self._conda_kspecs.get(kernel_name)
+        return None if kernel is None else self._load_kernel(kernel)
+
     def get_kernel_spec(self, kernel_name):
         """ Returns a :class:`KernelSpec` instance for the given kernel_name.
 
@@ -423,26 +1591,87 @@ class CondaKernelSpecManager(KernelSpecManager):
             accordingly with the detected environments.
         """
 
-        res = self._conda_kspecs.get(kernel_name)
+        kernel = self._conda_kspec(kernel_name)
+        res = None if kernel is None else kernel.to_kernel_spec()
         if res is None and not self.conda_only:
             res = super(CondaKernelSpecManager, self).get_kernel_spec(kernel_name)
         return res
 
+    def _native_kernel_spec(self, kernel_name, resource_dir):
+        """ Load a standard Jupyter kernel spec from a known resource
+            directory, without searching the kernel directories again.
+        """
+        get_spec = getattr(super(CondaKernelSpecManager, self), '_get_kernel_spec_by_name', None)
+        if get_spec is None:
+            # jupyter_client < 6.1
+            return self.kernel_spec_class.from_resource_dir(resource_dir)
+        return get_spec(kernel_name, resource_dir)
+
     def get_all_specs(self):
         """ Returns a dict mapping kernel names to dictionaries with two
             entries: "resource_dir" and "spec". This was added to fill out
             the full public interface to KernelManagerSpec.
+
+            All entries are built from a single snapshot of the conda
+            kernels, and each kernel.json is read at most once.
         """
+        conda_kspecs = self._conda_kspecs
         res = {}
-        for name, resource_dir in self.find_kernel_specs().items():
-            try:
-                spec = self.get_kernel_spec(name)
-                res[name] = {'resource_dir': resource_dir,
-                             'spec': spec.to_dict()}
-            except NoSuchKernel:
-                self.log.warning("Error loading kernelspec %r", name, exc_info=True)
+        with self._trace('kernel_specs') as attributes:
+            for name, resource_dir in self._merge_kspecs(conda_kspecs).items():
+                try:
+                    kernel = conda_kspecs.get(name)
+                    if kernel is None:
+                        spec = self._native_kernel_spec(name, resource_dir)
+                    elif self._load_kernel(kernel) is None:
+                        continue
+                    else:
+                        spec = kernel.to_kernel_spec()
+                    res[name] = {'resource_dir': resource_dir,
+                                 'spec': spec.to_dict()}
+                except (NoSuchKernel, OSError, ValueError):
+                    self.log.warning("Error loading kernelspec %r", name, exc_info=True)
+            attributes['kernel_count'] = len(res)
         return res
 
+    async def async_find_kernel_specs(self):
+        """ Asynchronous version of find_kernel_specs, for the async
+            handlers of jupyter_server: conda is run with asyncio, and the
+            environments are scanned in an executor.
+        """
+        return await self._run_in_executor(self.find_kernel_specs)
+
+    async def async_get_kernel_spec(self, kernel_name):
+        """ Asynchronous version of get_kernel_spec; see async_find_kernel_specs.
+        """
+        return await self._run_in_executor(self.get_kernel_spec, kernel_name)
+
+    async def async_get_all_specs(self):
+        """ Asynchronous version of get_all_specs; see async_find_kernel_specs.
+        """
+        return await self._run_in_executor(self.get_all_specs)
+
+    async def async_refresh(self):
+        """ Refresh the conda info and the conda kernels now, rather than
+            when their caches expire; e.g. right after an environment has
+            been created. Returns the new generation of the conda kernels.
+
+            A refresh already in progress may have started before the
+            change, so its result is not used: conda is run again once it
+            completes, and likewise for the conda kernels.
+        """
+        thread = self._conda_info_cache_thread
+        if thread is not None:
+            await asyncio.get_event_loop().run_in_executor(None, thread.join)
+            # Collect its result, if no other caller did
+            self._conda_info
+        task = self._conda_info_task
+        if task is not None and not task.done():
+            await task
+        task = self._conda_info_task = asyncio.ensure_future(self._async_refresh_conda_info())
+        await task
+        return await self._run_in_executor(self._refresh_now)
+
     def remove_kernel_spec(self, name):
         """Remove a kernel spec directory by name.
 
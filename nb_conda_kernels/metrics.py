@@ -0,0 +1,66 @@
+"""
+Prometheus metrics of the kernel discovery, registered in the default
+registry of prometheus_client, and therefore served by the /metrics
+endpoint of jupyter_server. Without prometheus_client, they do nothing.
+
+Read https://prometheus.io/docs/practices/naming/ for naming
+conventions for metrics & labels.
+"""
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram
+except ImportError:
+    Counter = Gauge = Histogram = None
+
+
+class _NoMetric(object):
+    """ Stands for any metric when prometheus_client is not installed.
+    """
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, amount):
+        pass
+
+
+if Counter is None:
+    CONDA_INFO_DURATION_SECONDS = CONDA_INFO_FAILURES = DISCOVERY_DURATION_SECONDS = \
+        ENVS_SCANNED = CONDA_KERNELS = CACHE_REQUESTS = KERNELSPECS_WRITTEN = _NoMetric()
+else:
+    CONDA_INFO_DURATION_SECONDS = Histogram(
+        "nb_conda_kernels_conda_info_duration_seconds",
+        "Duration of the calls to `conda info`, in seconds",
+    )
+    CONDA_INFO_FAILURES = Counter(
+        "nb_conda_kernels_conda_info_failures",
+        "Number of calls to `conda info` that failed or timed out",
+    )
+    DISCOVERY_DURATION_SECONDS = Histogram(
+        "nb_conda_kernels_discovery_duration_seconds",
+        "Duration of each phase of the discovery of the conda kernels, in seconds",
+        ["phase"],
+    )
+    ENVS_SCANNED = Counter(
+        "nb_conda_kernels_envs_scanned",
+        "Number of conda environments scanned for kernels",
+    )
+    CONDA_KERNELS = Gauge(
+        "nb_conda_kernels_kernels",
+        "Number of conda kernels found by the last refresh",
+    )
+    CACHE_REQUESTS = Counter(
+        "nb_conda_kernels_cache_requests",
+        "Number of requests to each cache, by result (hit or miss)",
+        ["cache", "result"],
+    )
+    KERNELSPECS_WRITTEN = Counter(
+        "nb_conda_kernels_kernelspecs_written",
+        "Number of kernel specs written to kernelspec_path",
+    )
@@ -10,27 +10,35 @@ except ImportError:
     from pipes import quote
 
 
+def activation_command(conda_prefix, env_path, *command):
+    # The command that runs the standard conda activation script, prints
+    # the resulting CONDA_PREFIX to stdout for reading, and runs command.
+    if sys.platform.startswith('win'):
+        activate = os.path.join(conda_prefix, 'Scripts', 'activate.bat')
+        return [os.environ['COMSPEC'], '/S', '/U', '/C', '@echo', 'off', '&&',
+                'chcp', '65001', '&&', 'call', activate, env_path, '&&',
+                '@echo', 'CONDA_PREFIX=%CONDA_PREFIX%', '&&',] + list(command)
+    quoted_command = [quote(c) for c in command]
+    activate = os.path.join(conda_prefix, 'bin', 'activate')
+    ecomm = ". '{}' '{}' && echo CONDA_PREFIX=$CONDA_PREFIX && exec {}".format(activate, env_path, ' '.join(quoted_command))
+    return ['sh' if 'bsd' in sys.platform else 'bash', '-c', ecomm]
+
+
 def exec_in_env(conda_prefix, env_path, *command):
-    # Run the standard conda activation script, and print the
-    # resulting environment variables to stdout for reading.
+    # Run the command in the environment, activating it first
+    # unless it is the current one.
     is_current_env = env_path == sys.prefix
     if sys.platform.startswith('win'):
         if is_current_env:
             subprocess.Popen(list(command)).wait()
         else:
-            activate = os.path.join(conda_prefix, 'Scripts', 'activate.bat')
-            ecomm = [os.environ['COMSPEC'], '/S', '/U', '/C', '@echo', 'off', '&&',
-                    'chcp', '65001', '&&', 'call', activate, env_path, '&&',
-                    '@echo', 'CONDA_PREFIX=%CONDA_PREFIX%', '&&',] + list(command)
-            subprocess.Popen(ecomm).wait()
+            subprocess.Popen(activation_command(conda_prefix, env_path, *command)).wait()
     else:
-        quoted_command = [quote(c) for c in command]
         if is_current_env:
+            quoted_command = [quote(c) for c in command]
             os.execvp(quoted_command[0], quoted_command)
         else:
-            activate = os.path.join(conda_prefix, 'bin', 'activate')
-            ecomm = ". '{}' '{}' && echo CONDA_PREFIX=$CONDA_PREFIX && exec {}".format(activate, env_path, ' '.join(quoted_command))
-            ecomm = ['sh' if 'bsd' in sys.platform else 'bash', '-c', ecomm]
+            ecomm = activation_command(conda_prefix, env_path, *command)
             os.execvp(ecomm[0], ecomm)
 
 
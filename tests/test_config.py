@@ -1,8 +1,17 @@
 from __future__ import print_function
 
+import asyncio
+import contextlib
+import glob
+import io
 import json
+import logging
 import os
+import subprocess
 import sys
+import threading
+import time
+import tracemalloc
 
 try:
     from unittest.mock import call, patch
@@ -11,7 +20,8 @@ except ImportError:
 
 import pytest
 from traitlets.config import Config, TraitError
-from nb_conda_kernels.manager import RUNNER_COMMAND, CondaKernelSpecManager, _canonicalize
+from nb_conda_kernels.manager import (RUNNER_COMMAND, SCAN_WORKERS, CondaKernelSpecManager,
+                                      _CanonicalPaths, _canonicalize)
 
 # The testing regime for nb_conda_kernels is unique, in that it needs to
 # see an entire conda installation with multiple environments and both
@@ -285,6 +295,834 @@ def test_kernel_metadata_debugger_override(monkeypatch, tmp_path, kernelspec):
     assert specs['conda-env-env_name-my_kernel']['metadata']['debugger'] is False
 
 
+def test_native_kernel_cache(monkeypatch, tmp_path):
+    kernel_dir = tmp_path / 'kernels'
+    kernel_file = kernel_dir / 'native' / 'kernel.json'
+    kernel_file.parent.mkdir(parents=True)
+    kernel_file.write_text(json.dumps({'display_name': 'native', 'argv': ['x'], 'language': 'x'}))
+
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", None)
+    manager = CondaKernelSpecManager(kernel_dirs=[str(kernel_dir)], ensure_native_kernel=False)
+    assert list(manager.find_kernel_specs()) == ['native']
+
+    # A warm lookup does not list any directory
+    with patch("os.listdir", side_effect=AssertionError("listdir called")):
+        assert list(manager.find_kernel_specs()) == ['native']
+
+    # Adding a kernel directory invalidates the cache
+    other_file = kernel_dir / 'other' / 'kernel.json'
+    other_file.parent.mkdir()
+    other_file.write_text(json.dumps({'display_name': 'other', 'argv': ['x'], 'language': 'x'}))
+    os.utime(str(kernel_dir), ns=(0, 0))
+    assert sorted(manager.find_kernel_specs()) == ['native', 'other']
+
+
+def test_canonicalize_stats_once(tmp_path):
+    env1 = tmp_path / 'Env1'
+    env2 = tmp_path / 'Env2'
+    env1.mkdir()
+    env2.mkdir()
+    assert _canonicalize(str(env1)) == str(env1)
+    # Known paths are answered without touching the filesystem
+    with patch("os.stat", side_effect=AssertionError("stat called")):
+        assert _canonicalize(str(env1)) == str(env1)
+    # The case sensitivity of the filesystem is probed only once
+    with patch("os.stat", wraps=os.stat) as stat:
+        assert _canonicalize(str(env2)) == str(env2)
+        assert stat.call_count == 1
+
+
+def test_canonical_paths_bounded(monkeypatch, tmp_path):
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", None)
+    manager = CondaKernelSpecManager(canonical_paths_size=100)
+    canonicalize = manager._canonicalize
+
+    def churn(cycles):
+        # Plain strings, so that only the canonicalization is measured
+        for count in range(cycles):
+            env = os.path.join(str(tmp_path), 'env{}'.format(count))
+            os.mkdir(env)
+            assert canonicalize(env) == env
+            assert canonicalize(env) == env
+            os.rmdir(env)
+
+    churn(1000)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        churn(3000)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert len(canonicalize) == 100
+    assert canonicalize.hits == canonicalize.misses == 4000
+    assert after - before < 64 * 1024
+
+
+def test_canonical_paths_concurrent(tmp_path):
+    canonicalize = _CanonicalPaths(maxsize=10)
+    paths = [os.path.join(str(tmp_path), str(count)) for count in range(50)]
+    for path in paths:
+        os.mkdir(path)
+    errors = []
+
+    def churn():
+        try:
+            for _ in range(200):
+                for path in paths:
+                    assert canonicalize(path) == path
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=churn) for _ in range(SCAN_WORKERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(canonicalize) == 10
+
+
+def test_get_kernel_spec_targeted(monkeypatch, tmp_path):
+    kernelspec = {'display_name': 'Python 3', 'argv': ['python'], 'language': 'python'}
+    envs = {}
+    for env_name in ('env1', 'env2'):
+        env_path = tmp_path / env_name
+        kernel_file = env_path / 'share' / 'jupyter' / 'kernels' / 'python3' / 'kernel.json'
+        kernel_file.parent.mkdir(parents=True)
+        kernel_file.write_text(json.dumps(kernelspec))
+        envs[env_name] = str(env_path)
+
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", {'conda_prefix': '/'})
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_envs", lambda self: envs)
+    manager = CondaKernelSpecManager(conda_only=True)
+
+    # Once the cache has expired, only the requested kernel is read again
+    manager._snapshot = manager._snapshot._replace(expiry=0)
+    with patch("glob.glob", side_effect=AssertionError("full scan")):
+        spec = manager.get_kernel_spec('conda-env-env2-py')
+    assert spec.metadata['conda_env_path'] == envs['env2']
+    assert spec.argv == RUNNER_COMMAND + ['/', envs['env2'], 'python']
+
+
+def test_kernel_spec_loaded_on_demand(monkeypatch, tmp_path):
+    kernelspec = {'display_name': 'Python 3', 'argv': ['python'], 'language': 'python'}
+    kernel_file = tmp_path / 'share' / 'jupyter' / 'kernels' / 'python3' / 'kernel.json'
+    kernel_file.parent.mkdir(parents=True)
+    kernel_file.write_text(json.dumps(kernelspec))
+
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", {'conda_prefix': '/'})
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_envs", lambda self: {'env': str(tmp_path)})
+    with patch("json.loads", wraps=json.loads) as load:
+        manager = CondaKernelSpecManager(conda_only=True)
+        assert manager.find_kernel_specs() == {'conda-env-env-py': str(kernel_file.parent)}
+        assert load.call_count == 0
+        spec = manager.get_kernel_spec('conda-env-env-py')
+        assert spec.display_name == 'Python [conda env:env]'
+        assert manager.get_all_specs()['conda-env-env-py']['spec'] == spec.to_dict()
+        assert load.call_count == 1
+
+
+@pytest.mark.parametrize("content", ['{', '{"display_name": "Python 3"}', '{"argv": ["python"]}'])
+def test_broken_kernel_spec_not_listed(monkeypatch, tmp_path, content):
+    kernel_dir = tmp_path / 'share' / 'jupyter' / 'kernels'
+    (kernel_dir / 'python3').mkdir(parents=True)
+    (kernel_dir / 'python3' / 'kernel.json').write_text(
+        json.dumps({'display_name': 'Python 3', 'argv': ['python']}))
+    (kernel_dir / 'broken').mkdir()
+    (kernel_dir / 'broken' / 'kernel.json').write_text(content)
+
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", {'conda_prefix': '/'})
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_envs", lambda self: {'env': str(tmp_path)})
+    monkeypatch.setattr(CondaKernelSpecManager, "_native_kspecs", {})
+    manager = CondaKernelSpecManager()
+    assert sorted(manager.get_all_specs()) == ['conda-env-env-py']
+    # Once its kernel.json has failed to load, the kernel is no longer listed
+    assert sorted(manager.find_kernel_specs()) == ['conda-env-env-py']
+    for name in manager.find_kernel_specs():
+        assert manager.get_kernel_spec(name).argv
+
+
+def _quadratic_env_names(env_paths, envs_prefix):
+    # The naming pass of _all_envs before it was made linear
+    all_envs = {}
+    for env_path in env_paths:
+        env_base, env_name = os.path.split(env_path)
+        if os.path.basename(env_base) == 'envs' and (env_base != envs_prefix or env_name in all_envs):
+            env_name = u'{}-{}'.format(os.path.basename(os.path.dirname(env_base)), env_name)
+        if env_name in all_envs:
+            base_name = env_name
+            for count in range(len(all_envs)):
+                env_name = u'{}-{}'.format(base_name, count + 2)
+                if env_name not in all_envs:
+                    break
+        all_envs[env_name] = env_path
+    return all_envs
+
+
+def test_env_names_unchanged(monkeypatch):
+    root = os.path.abspath(os.path.join(os.sep, 'nonexistent', 'conda'))
+    envs_prefix = os.path.join(root, 'envs')
+    env_paths = []
+    for count in range(50):
+        env_paths.append(os.path.join(root, 'projects', str(count), 'proj', 'envs', 'dev'))
+        env_paths.append(os.path.join(envs_prefix, 'proj-dev-{}'.format(count % 7 + 2)))
+        env_paths.append(os.path.join(root, 'proj', 'envs', 'dev-{}'.format(count)))
+        env_paths.append(os.path.join(envs_prefix, 'dev'))
+        env_paths.append(os.path.join(root, 'other{}'.format(count % 3), 'dev'))
+    conda_info = {'conda_prefix': root, 'envs': [root] + env_paths, 'envs_dirs': [envs_prefix]}
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", conda_info)
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_kernels", lambda self, envs=None, filters=True: {})
+
+    manager = CondaKernelSpecManager(env_path_preference=None)
+    expected = {'base': root}
+    expected.update(_quadratic_env_names(env_paths, envs_prefix))
+    assert manager._all_envs() == expected
+
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason='Requires symbolic links')
+@pytest.mark.parametrize("preference, expected", [
+    ('first', ['shared']),
+    ('shortest', ['x']),
+    ('realpath', ['real']),
+    (None, ['shared', 'x']),
+])
+def test_duplicate_envs(monkeypatch, tmp_path, preference, expected):
+    real = tmp_path / 'real'
+    real.mkdir()
+    (tmp_path / 'shared').symlink_to(real)
+    (tmp_path / 'x').symlink_to(real)
+    base = tmp_path / 'base'
+    base.mkdir()
+    conda_info = {'conda_prefix': str(base), 'envs_dirs': [],
+                  'envs': [str(base), str(tmp_path / 'shared'), str(tmp_path / 'x')]}
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", conda_info)
+
+    manager = CondaKernelSpecManager(env_path_preference=preference)
+    all_envs = manager._all_envs()
+    assert all_envs.pop('base') == str(base)
+    assert sorted(all_envs) == expected
+    for name in expected:
+        assert os.path.basename(all_envs[name]) == name
+
+
+def test_kernel_filters_scan_less(monkeypatch, tmp_path):
+    envs = {}
+    for env_name, kernel, language in (('env1', 'python3', 'python'),
+                                       ('env2', 'python3', 'python'),
+                                       ('env2', 'ir', 'R')):
+        env_path = tmp_path / env_name
+        kernel_file = env_path / 'share' / 'jupyter' / 'kernels' / kernel / 'kernel.json'
+        kernel_file.parent.mkdir(parents=True)
+        kernel_file.write_text(json.dumps({'display_name': kernel, 'argv': ['x'], 'language': language}))
+        envs[env_name] = str(env_path)
+
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", {'conda_prefix': '/'})
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_envs", lambda self: envs)
+
+    with patch("glob.glob", wraps=glob.glob) as scan, \
+            patch("json.loads", wraps=json.loads) as load:
+        manager = CondaKernelSpecManager(conda_only=True,
+                                         allowed_kernelspecs={'conda-env-env2-r'})
+        assert list(manager.find_kernel_specs()) == ['conda-env-env2-r']
+        scanned = [call_[0][0] for call_ in scan.call_args_list]
+        assert len(scanned) == 1 and envs['env2'] in scanned[0]
+        assert load.call_count == 0
+
+    manager = CondaKernelSpecManager(conda_only=True, allowed_languages=['Python'])
+    assert sorted(manager.find_kernel_specs()) == ['conda-env-env1-py', 'conda-env-env2-py']
+
+    # The filters only apply to the listing: every conda kernel is still
+    # installed to kernelspec_path, and none is removed as stale
+    kernelspec_path = tmp_path / 'installed'
+    kernelspec_path.mkdir()
+    install_dir = kernelspec_path / 'share' / 'jupyter' / 'kernels'
+    manager = CondaKernelSpecManager(kernelspec_path=str(kernelspec_path),
+                                     allowed_languages=['Python'])
+    assert sorted(manager.find_kernel_specs()) == ['conda-env-env1-py', 'conda-env-env2-py']
+    assert sorted(os.listdir(str(install_dir))) == ['conda-env-env1-py', 'conda-env-env2-py', 'conda-env-env2-r']
+    manager = CondaKernelSpecManager(kernelspec_path=str(kernelspec_path),
+                                     allowed_kernelspecs={'conda-env-env2-r'})
+    assert list(manager.find_kernel_specs()) == ['conda-env-env2-r']
+    assert sorted(os.listdir(str(install_dir))) == ['conda-env-env1-py', 'conda-env-env2-py', 'conda-env-env2-r']
+
+
+@pytest.mark.parametrize("options, expected", [
+    ({}, ['base', 'dev', 'proj-dev', 'ml']),
+    ({'env_filter': 'proj'}, ['base', 'dev', 'ml']),
+    ({'env_include': ['conda.envs.d']}, ['dev']),
+    ({'env_include_glob': ['*/proj/*']}, ['proj-dev']),
+    ({'env_include': ['ml$'], 'env_include_glob': ['*/conda']}, ['base', 'ml']),
+    ({'env_include': ['envs'], 'env_filter': 'ml'}, ['dev', 'proj-dev']),
+    ({'env_include': ['(?i)/SRV/', 'ml$']}, ['proj-dev', 'ml']),
+    ({'env_max_depth': 4}, ['base', 'dev', 'ml']),
+])
+def test_env_selection(monkeypatch, options, expected):
+    root = os.path.join(os.sep, 'opt', 'conda')
+    envs = [root,
+            os.path.join(root, 'envs', 'dev'),
+            os.path.join(os.sep, 'srv', 'projects', 'proj', 'envs', 'dev'),
+            os.path.join(root, 'envs', 'ml')]
+    conda_info = {'conda_prefix': root, 'envs': envs, 'envs_dirs': []}
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", conda_info)
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_kernels", lambda self, envs=None, filters=True: {})
+
+    manager = CondaKernelSpecManager(**options)
+    with patch("os.stat", side_effect=OSError) as stat:
+        names = sorted(manager._all_envs())
+        stat_paths = set(call_[0][0] for call_ in stat.call_args_list)
+    assert names == sorted(expected)
+    # The excluded environments are never touched
+    excluded = set(envs[1:]) - set(manager._all_envs().values())
+    assert not (stat_paths & excluded)
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason='Requires user ids')
+def test_env_owner_only(monkeypatch, tmp_path):
+    mine = tmp_path / 'mine'
+    mine.mkdir()
+    root = os.path.join(os.sep, 'nonexistent', 'conda')
+    conda_info = {'conda_prefix': root, 'envs': [root, str(mine)], 'envs_dirs': []}
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", conda_info)
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_kernels", lambda self, envs=None, filters=True: {})
+
+    manager = CondaKernelSpecManager(env_owner_only=True)
+    assert manager._all_envs() == {'mine': str(mine)}
+
+
+def test_env_scan_timeout(monkeypatch, tmp_path, caplog):
+    envs = {}
+    for env_name in ('fast', 'slow', 'new'):
+        kernel_file = tmp_path / env_name / 'share' / 'jupyter' / 'kernels' / 'python3' / 'kernel.json'
+        kernel_file.parent.mkdir(parents=True)
+        kernel_file.write_text(json.dumps({'display_name': 'Python 3', 'argv': ['python']}))
+        envs[env_name] = str(tmp_path / env_name)
+    hung = threading.Event()
+    release = threading.Event()
+    scan_env = CondaKernelSpecManager._scan_env
+
+    def slow_scan(env_path):
+        if hung.is_set() and env_path != envs['fast']:
+            release.wait()
+        return scan_env(env_path)
+
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", {'conda_prefix': '/'})
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_envs", lambda self: {'fast': envs['fast'], 'slow': envs['slow']})
+    monkeypatch.setattr(CondaKernelSpecManager, "_scan_env", staticmethod(slow_scan))
+    manager = CondaKernelSpecManager(conda_only=True, env_scan_timeout=0.2)
+    expected = ['conda-env-fast-py', 'conda-env-slow-py']
+    assert sorted(manager._all_kernels()) == expected
+
+    # A hung environment is served from its last known scan, a new one omitted
+    hung.set()
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_envs", lambda self: envs)
+    try:
+        assert sorted(manager._all_kernels()) == expected
+        assert envs['slow'] in caplog.text and envs['new'] in caplog.text
+    finally:
+        release.set()
+
+    # Once the scan has completed in the background, its result is used
+    manager._pending_scans[envs['new']].result(timeout=5)
+    hung.clear()
+    assert sorted(manager._all_kernels()) == sorted(expected + ['conda-env-new-py'])
+
+
+def test_env_scan_timeout_per_env(monkeypatch, tmp_path):
+    envs = {}
+    for count in range(SCAN_WORKERS):
+        envs['hung{}'.format(count)] = str(tmp_path / 'hung{}'.format(count))
+    for count in range(5 * SCAN_WORKERS):
+        env_path = tmp_path / 'env{}'.format(count)
+        kernel_file = env_path / 'share' / 'jupyter' / 'kernels' / 'python3' / 'kernel.json'
+        kernel_file.parent.mkdir(parents=True)
+        kernel_file.write_text(json.dumps({'display_name': 'Python 3', 'argv': ['python']}))
+        envs['env{}'.format(count)] = str(env_path)
+    release = threading.Event()
+    scan_env = CondaKernelSpecManager._scan_env
+
+    def slow_scan(env_path):
+        if 'hung' in env_path:
+            release.wait()
+        time.sleep(0.1)
+        return scan_env(env_path)
+
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", {'conda_prefix': '/'})
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_envs", lambda self: envs)
+    monkeypatch.setattr(CondaKernelSpecManager, "_scan_env", staticmethod(slow_scan))
+    try:
+        # Each scan has its own deadline from its start, and the scans
+        # queued behind the hung ones are not held back by them
+        manager = CondaKernelSpecManager(conda_only=True, env_scan_timeout=0.3)
+        assert len(manager.find_kernel_specs()) == 5 * SCAN_WORKERS
+        assert len(manager._pending_scans) == SCAN_WORKERS
+    finally:
+        release.set()
+
+
+def test_env_scan_timeout_stat(monkeypatch, tmp_path):
+    kernel_file = tmp_path / 'envs' / 'ok' / 'share' / 'jupyter' / 'kernels' / 'python3' / 'kernel.json'
+    kernel_file.parent.mkdir(parents=True)
+    kernel_file.write_text(json.dumps({'display_name': 'Python 3', 'argv': ['python']}))
+    hung = str(tmp_path / 'envs' / 'hung')
+    conda_info = {'conda_prefix': str(tmp_path), 'envs': [str(tmp_path / 'envs' / 'ok'), hung],
+                  'envs_dirs': [str(tmp_path / 'envs')]}
+    release = threading.Event()
+    stat = os.stat
+
+    def hung_stat(path, *args, **kwargs):
+        if str(path).startswith(hung):
+            release.wait(10)
+        return stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", conda_info)
+    monkeypatch.setattr(os, "stat", hung_stat)
+    try:
+        # The environments are stat'd in the background, like their scans
+        start = time.time()
+        manager = CondaKernelSpecManager(conda_only=True, env_scan_timeout=0.2)
+        assert sorted(manager._all_envs()) == ['base', 'hung', 'ok']
+        assert list(manager.find_kernel_specs()) == ['conda-env-ok-py']
+        assert time.time() - start < 5
+        assert list(manager._pending_stats) == [hung]
+    finally:
+        release.set()
+
+
+def test_conda_failure_keeps_last_info(tmp_path):
+    conda_info = {'conda_prefix': str(tmp_path), 'envs': [], 'envs_dirs': []}
+    info_file = tmp_path / 'conda_info.json'
+    outputs = [json.dumps(conda_info).encode()]
+
+    def check_output(cmd, **kwargs):
+        assert kwargs['timeout'] == 5
+        if outputs:
+            return outputs.pop()
+        raise subprocess.TimeoutExpired(cmd, kwargs['timeout'])
+
+    with patch("subprocess.check_output", side_effect=check_output):
+        manager = CondaKernelSpecManager(conda_timeout=5, conda_info_file=str(info_file),
+                                         conda_info_fingerprint=False)
+        assert manager._conda_info == conda_info
+        assert json.loads(info_file.read_text()) == conda_info
+
+        # A failed refresh keeps the last result, and is retried with backoff
+        delays = []
+        for count in range(3):
+            manager._conda_info_cache_expiry = 0
+            assert manager._conda_info == conda_info
+            manager._conda_info_cache_thread.join()
+            start = time.time()
+            assert manager._conda_info == conda_info
+            delays.append(manager._conda_info_cache_expiry - start)
+        assert [round(delay) for delay in delays] == [5, 10, 20]
+
+        # A new manager falls back on the saved result
+        manager = CondaKernelSpecManager(conda_timeout=5, conda_info_file=str(info_file))
+        assert manager._conda_info == conda_info
+
+
+@pytest.mark.parametrize("adaptive, expected", [
+    (False, [30, 30, 30, 30]),
+    (True, [60, 100, 50, 25]),
+])
+def test_adaptive_cache_timeout(monkeypatch, tmp_path, adaptive, expected):
+    kernel_dir = tmp_path / 'share' / 'jupyter' / 'kernels'
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", {'conda_prefix': '/'})
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_envs", lambda self: {'env': str(tmp_path)})
+    manager = CondaKernelSpecManager(kernels_cache_timeout=30, adaptive_cache_timeout=adaptive,
+                                     min_cache_timeout=20, max_cache_timeout=100)
+    timeouts = []
+    for kernel in (None, None, 'python3', 'ir'):
+        if kernel:
+            (kernel_dir / kernel).mkdir(parents=True)
+            (kernel_dir / kernel / 'kernel.json').write_text('{}')
+        manager._snapshot = manager._snapshot._replace(expiry=0)
+        manager._conda_kspecs
+        timeouts.append(manager._conda_kernels_ttl)
+    assert timeouts == expected
+
+
+def test_conda_info_fingerprint(tmp_path):
+    envs_dir = tmp_path / 'envs'
+    envs_dir.mkdir()
+    condarc = tmp_path / '.condarc'
+    condarc.write_text('')
+    conda_info = {'conda_prefix': str(tmp_path), 'root_prefix': str(tmp_path), 'envs': [],
+                  'envs_dirs': [str(envs_dir)], 'config_files': [str(condarc)]}
+
+    def refresh(manager):
+        manager._conda_info_cache_expiry = 0
+        manager._conda_info
+        if manager._conda_info_cache_thread:
+            manager._conda_info_cache_thread.join()
+            manager._conda_info
+
+    with patch("subprocess.check_output", return_value=json.dumps(conda_info).encode()) as conda:
+        manager = CondaKernelSpecManager()
+        # The first fingerprint does not know the paths from conda info yet
+        refresh(manager)
+        assert conda.call_count == 2
+        refresh(manager)
+        assert conda.call_count == 2
+        (envs_dir / 'new').mkdir()
+        os.utime(str(envs_dir), ns=(0, 0))
+        refresh(manager)
+        assert conda.call_count == 3
+        condarc.write_text('envs_dirs: []')
+        refresh(manager)
+        assert conda.call_count == 4
+        refresh(manager)
+        assert conda.call_count == 4
+
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason="uses a shell script as conda")
+@pytest.mark.parametrize("sleep", [0, 10])
+def test_async_api(monkeypatch, tmp_path, sleep):
+    env_path = tmp_path / 'envs' / 'env'
+    kernel_dir = env_path / 'share' / 'jupyter' / 'kernels' / 'python3'
+    kernel_dir.mkdir(parents=True)
+    (kernel_dir / 'kernel.json').write_text(json.dumps(
+        {'argv': ['python', '-m', 'ipykernel'], 'display_name': 'Python 3', 'language': 'python'}))
+    conda_info = {'conda_prefix': str(tmp_path), 'envs': [str(env_path)],
+                  'envs_dirs': [str(tmp_path / 'envs')]}
+    info_file = tmp_path / 'info.json'
+    info_file.write_text(json.dumps(conda_info))
+    conda = tmp_path / 'conda'
+    conda.write_text('#!/bin/sh\nsleep {}\ncat "{}"\n'.format(sleep, info_file))
+    conda.chmod(0o755)
+    monkeypatch.setattr("nb_conda_kernels.manager.CONDA_EXE", str(conda))
+
+    manager = CondaKernelSpecManager(conda_only=True, conda_timeout=2,
+                                     conda_info_fingerprint=False)
+    expected = manager.get_all_specs()
+    failures = manager._conda_info_failures
+    manager._conda_info_cache = manager._conda_info_cache_expiry = None
+    manager._snapshot = None
+
+    # conda must be run by asyncio, never by the blocking call
+    with patch("subprocess.check_output", side_effect=AssertionError):
+        if sleep:
+            assert asyncio.run(manager.async_find_kernel_specs()) == {}
+            assert manager._conda_info_failures == failures + 1
+        else:
+            assert asyncio.run(manager.async_get_all_specs()) == expected
+            name, = expected
+            spec = asyncio.run(manager.async_get_kernel_spec(name))
+            assert spec.to_dict() == expected[name]['spec']
+
+            # Once both caches have expired, the executor uses the cached
+            # conda info while asyncio refreshes it
+            conda.write_text('#!/bin/sh\nsleep 1\ncat "{}"\n'.format(info_file))
+            manager._conda_info_cache_expiry = 0
+            manager._snapshot = manager._snapshot._replace(expiry=0)
+
+            async def refresh():
+                kernel_specs = await manager.async_find_kernel_specs()
+                await manager._conda_info_task
+                return kernel_specs
+
+            assert asyncio.run(refresh()) == {name: expected[name]['resource_dir']}
+            assert manager._conda_info_cache_thread is None
+            assert manager._conda_info_failures == failures
+            assert manager._conda_info_cache_expiry > time.time()
+
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason="uses a shell script as conda")
+def test_async_conda_info_without_subprocesses(monkeypatch, tmp_path):
+    conda_info = {'conda_prefix': str(tmp_path), 'envs': [], 'envs_dirs': []}
+    conda = tmp_path / 'conda'
+    conda.write_text("#!/bin/sh\necho '{}'\n".format(json.dumps(conda_info)))
+    conda.chmod(0o755)
+    monkeypatch.setattr("nb_conda_kernels.manager.CONDA_EXE", str(conda))
+
+    manager = CondaKernelSpecManager(conda_only=True, conda_info_fingerprint=False)
+    failures = manager._conda_info_failures
+    manager._conda_info_cache = manager._conda_info_cache_expiry = None
+
+    # Like the selector event loop on Windows
+    with patch("asyncio.create_subprocess_exec", side_effect=NotImplementedError), \
+            patch("subprocess.check_output", wraps=subprocess.check_output) as check_output:
+        assert asyncio.run(manager._async_conda_info()) == conda_info
+    assert check_output.call_count == 1
+    assert manager._conda_info_failures == failures
+    assert manager._conda_info_cache_expiry > time.time()
+
+
+def test_async_refresh_during_refresh(monkeypatch, tmp_path):
+    envs = {}
+    conda_refreshes = []
+
+    async def refresh_conda_info(self):
+        conda_refreshes.append(self)
+
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", {'conda_prefix': '/', 'envs': []})
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_envs", lambda self: dict(envs))
+    monkeypatch.setattr(CondaKernelSpecManager, "_async_refresh_conda_info", refresh_conda_info)
+
+    def add_env(name):
+        kernel_dir = tmp_path / name / 'share' / 'jupyter' / 'kernels' / 'python3'
+        kernel_dir.mkdir(parents=True)
+        (kernel_dir / 'kernel.json').write_text('{}')
+        envs[name] = str(tmp_path / name)
+
+    add_env('a')
+    manager = CondaKernelSpecManager(conda_only=True)
+    assert manager.generation == 1
+
+    # A refresh which scanned the environments before 'b' was created
+    scanned, release = threading.Event(), threading.Event()
+    refresh_snapshot = manager._refresh_snapshot
+
+    def slow_refresh(snapshot, conda_info):
+        result = refresh_snapshot(snapshot, conda_info)
+        scanned.set()
+        release.wait(10)
+        return result
+
+    manager._refresh_snapshot = slow_refresh
+    manager._snapshot = manager._snapshot._replace(expiry=0)
+    thread = threading.Thread(target=lambda: manager.generation)
+    thread.start()
+    assert scanned.wait(10)
+    manager._refresh_snapshot = refresh_snapshot
+    add_env('b')
+    # A conda info refresh started before the request is not used either
+    manager._conda_info_cache_thread = threading.Thread(target=release.wait, args=(10,))
+    manager._conda_info_cache_thread.start()
+    threading.Timer(0.5, release.set).start()
+    assert asyncio.run(manager.async_refresh()) == 2
+    thread.join()
+    assert sorted(manager._snapshot.kernels) == ['conda-env-a-py', 'conda-env-b-py']
+    assert not manager._snapshot.expired()
+    assert len(conda_refreshes) == 1
+
+
+def test_snapshot_generation(monkeypatch, tmp_path):
+    kernel_dir = tmp_path / 'share' / 'jupyter' / 'kernels'
+    (kernel_dir / 'python3').mkdir(parents=True)
+    (kernel_dir / 'python3' / 'kernel.json').write_text('{}')
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", {'conda_prefix': '/', 'envs': []})
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_envs", lambda self: {'env': str(tmp_path)})
+    manager = CondaKernelSpecManager(conda_only=True)
+    first = manager._snapshot
+    assert manager.generation == first.generation == 1
+    assert dict(first.envs) == {'env': str(tmp_path)}
+    assert first.conda_info['conda_prefix'] == '/'
+    with pytest.raises(TypeError):
+        first.kernels['other'] = None
+
+    # A refresh that finds the same kernels keeps the generation
+    manager._snapshot = first._replace(expiry=0)
+    assert manager.generation == 1
+    assert manager._snapshot.timestamp >= first.timestamp
+
+    # While a refresh is in progress, readers keep the previous snapshot
+    (kernel_dir / 'ir').mkdir()
+    (kernel_dir / 'ir' / 'kernel.json').write_text('{}')
+    manager._snapshot = manager._snapshot._replace(expiry=0)
+    with manager._snapshot_lock:
+        assert list(manager._conda_kspecs) == ['conda-env-env-py']
+    assert sorted(manager._conda_kspecs) == ['conda-env-env-py', 'conda-env-env-r']
+    assert manager.generation == 2
+    assert list(first.kernels) == ['conda-env-env-py']
+
+
+def test_changes_since(monkeypatch, tmp_path):
+    envs = {}
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", {'conda_prefix': '/', 'envs': []})
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_envs", lambda self: dict(envs))
+
+    def add_env(name):
+        kernel_dir = tmp_path / name / 'share' / 'jupyter' / 'kernels' / 'python3'
+        kernel_dir.mkdir(parents=True)
+        (kernel_dir / 'kernel.json').write_text('{}')
+        envs[name] = str(tmp_path / name)
+
+    def refresh():
+        manager._snapshot = manager._snapshot._replace(expiry=0)
+        return manager.generation
+
+    add_env('a')
+    manager = CondaKernelSpecManager(conda_only=True)
+    observed = []
+    manager.observe(lambda change: observed.append(change['new']), names='kernel_changes')
+    assert manager.kernel_changes == {'generation': 1, 'added': ['conda-env-a-py'],
+                                      'removed': [], 'changed': []}
+    assert refresh() == 1
+    assert observed == []
+
+    add_env('b')
+    assert refresh() == 2
+    del envs['a']
+    add_env('b2')
+    envs['b'] = envs.pop('b2')
+    assert refresh() == 3
+    assert observed == [
+        {'generation': 2, 'added': ['conda-env-b-py'], 'removed': [], 'changed': []},
+        {'generation': 3, 'added': [], 'removed': ['conda-env-a-py'], 'changed': ['conda-env-b-py']},
+    ]
+    assert manager.changes_since(3) == {'generation': 3, 'added': [], 'removed': [], 'changed': []}
+    # A generation from the future, e.g. from before a restart, is unknown
+    assert manager.changes_since(4) is None
+    assert manager.changes_since(1) == {'generation': 3, 'added': ['conda-env-b-py'],
+                                        'removed': ['conda-env-a-py'], 'changed': []}
+    assert manager.changes_since(0) == {'generation': 3, 'added': ['conda-env-b-py'],
+                                        'removed': [], 'changed': []}
+    manager._changes.popleft()
+    assert manager.changes_since(0) is None
+
+
+def test_kernel_change_events(monkeypatch, tmp_path):
+    jupyter_events = pytest.importorskip("jupyter_events")
+    stream = io.StringIO()
+    event_logger = jupyter_events.EventLogger(handlers=[logging.StreamHandler(stream)])
+    kernel_dir = tmp_path / 'share' / 'jupyter' / 'kernels'
+    (kernel_dir / 'python3').mkdir(parents=True)
+    (kernel_dir / 'python3' / 'kernel.json').write_text('{}')
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", {'conda_prefix': '/', 'envs': []})
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_envs", lambda self: {'env': str(tmp_path)})
+
+    manager = CondaKernelSpecManager(conda_only=True, event_logger=event_logger)
+    for kernel in (None, 'ir'):
+        if kernel:
+            (kernel_dir / kernel).mkdir()
+            (kernel_dir / kernel / 'kernel.json').write_text('{}')
+        manager._snapshot = manager._snapshot._replace(expiry=0)
+        manager.find_kernel_specs()
+    events = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [event['__schema__'] for event in events] == [
+        'https://events.jupyter.org/nb_conda_kernels/kernelspecs/v1'] * 2
+    assert [(e['generation'], e['added'], e['kernel_count'], e['env_count']) for e in events] == [
+        (1, ['conda-env-env-py'], 1, 1), (2, ['conda-env-env-r'], 2, 1)]
+    assert all(event['duration'] >= 0 for event in events)
+
+
+def test_metrics(monkeypatch, tmp_path):
+    prometheus_client = pytest.importorskip("prometheus_client")
+
+    def sample(name, **labels):
+        return prometheus_client.REGISTRY.get_sample_value('nb_conda_kernels_' + name, labels) or 0
+
+    names = [('cache_requests_total', {'cache': 'conda_kernels', 'result': 'hit'}),
+             ('cache_requests_total', {'cache': 'conda_kernels', 'result': 'miss'}),
+             ('envs_scanned_total', {}),
+             ('kernelspecs_written_total', {}),
+             ('discovery_duration_seconds_count', {'phase': 'specs'}),
+             ('conda_info_failures_total', {}),
+             ('conda_info_duration_seconds_count', {})]
+    before = [sample(name, **labels) for name, labels in names]
+
+    kernel_dir = tmp_path / 'env' / 'share' / 'jupyter' / 'kernels' / 'python3'
+    kernel_dir.mkdir(parents=True)
+    (kernel_dir / 'kernel.json').write_text(json.dumps({'argv': ['python'], 'display_name': 'Python 3'}))
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_envs", lambda self: {'env': str(tmp_path / 'env')})
+    with patch("subprocess.check_output", side_effect=subprocess.CalledProcessError(1, 'conda')):
+        assert CondaKernelSpecManager()._conda_info is None
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", {'conda_prefix': '/', 'envs': []})
+    (tmp_path / 'install').mkdir()
+    manager = CondaKernelSpecManager(kernelspec_path=str(tmp_path / 'install'))
+    manager.find_kernel_specs()
+
+    after = [sample(name, **labels) for name, labels in names]
+    assert [a - b for a, b in zip(after, before)] == [1, 1, 1, 1, 1, 1, 1]
+    assert sample('kernels') == 1
+
+
+def test_trace_hooks(monkeypatch, tmp_path):
+    kernel_dir = tmp_path / 'env' / 'share' / 'jupyter' / 'kernels' / 'python3'
+    kernel_dir.mkdir(parents=True)
+    (kernel_dir / 'kernel.json').write_text(json.dumps({'argv': ['python'], 'display_name': 'Python 3'}))
+    stale_dir = tmp_path / 'install' / 'share' / 'jupyter' / 'kernels' / 'conda-env-old-py'
+    stale_dir.mkdir(parents=True)
+    (stale_dir / 'kernel.json').write_text('{}')
+    conda_info = {'conda_prefix': str(tmp_path), 'envs': [str(tmp_path / 'env')], 'envs_dirs': []}
+
+    spans = []
+
+    class Tracer(object):
+        @contextlib.contextmanager
+        def start_as_current_span(self, name):
+            span = type('Span', (), {'set_attributes': lambda self, a: spans.append((name, a))})()
+            yield span
+
+    monkeypatch.setattr("nb_conda_kernels.manager._tracer", Tracer())
+    calls = []
+
+    def hook(event, phase, attributes):
+        calls.append((event, phase, dict(attributes)))
+
+    def broken_hook(event, phase, attributes):
+        raise RuntimeError("broken")
+
+    with patch("subprocess.check_output", return_value=json.dumps(conda_info).encode()):
+        manager = CondaKernelSpecManager(kernelspec_path=str(tmp_path / 'install'),
+                                         trace_hooks=[hook, broken_hook])
+    assert [(event, phase) for event, phase, _ in calls] == [
+        ('start', 'conda_info'), ('end', 'conda_info'),
+        ('start', 'refresh'),
+        ('start', 'all_envs'), ('end', 'all_envs'),
+        ('start', 'all_kernels'),
+        ('start', 'scan_env'), ('end', 'scan_env'),  # base
+        ('start', 'scan_env'), ('end', 'scan_env'),
+        ('end', 'all_kernels'),
+        ('start', 'all_specs'),
+        ('start', 'install_kernelspec'), ('end', 'install_kernelspec'),
+        ('start', 'remove_stale_kernelspecs'), ('end', 'remove_stale_kernelspecs'),
+        ('end', 'all_specs'),
+        ('end', 'refresh')]
+    ends = {phase: attributes for event, phase, attributes in calls if event == 'end'}
+    assert all(attributes['duration'] >= 0 for attributes in ends.values())
+    assert ends['conda_info']['mode'] == 'blocking'
+    assert ends['scan_env'] == dict(ends['scan_env'], env_path=str(tmp_path / 'env'), kernel_count=1)
+    assert ends['install_kernelspec']['kernel_name'] == 'conda-env-env-py'
+    assert ends['remove_stale_kernelspecs']['removed_count'] == 1
+    assert ends['refresh'] == dict(ends['refresh'], generation=1, kernel_count=1, env_count=2)
+    assert [name for name, _ in spans] == ['nb_conda_kernels.' + phase for event, phase, _ in calls
+                                           if event == 'end']
+    assert dict(spans[-1][1], duration=0) == dict(ends['refresh'], duration=0)
+    assert manager.generation == 1
+
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason="uses a shell script as conda")
+def test_list_timings(tmp_path):
+    envs = []
+    for env_name in ('env1', 'env2'):
+        kernel_dir = tmp_path / 'envs' / env_name / 'share' / 'jupyter' / 'kernels' / 'python3'
+        kernel_dir.mkdir(parents=True)
+        (kernel_dir / 'kernel.json').write_text(json.dumps(
+            {'argv': ['python'], 'display_name': 'Python 3', 'language': 'python'}))
+        envs.append(str(tmp_path / 'envs' / env_name))
+    info_file = tmp_path / 'info.json'
+    info_file.write_text(json.dumps({'conda_prefix': str(tmp_path), 'envs': envs,
+                                     'envs_dirs': [str(tmp_path / 'envs')]}))
+    conda = tmp_path / 'conda'
+    conda.write_text('#!/bin/sh\ncat "{}"\n'.format(info_file))
+    conda.chmod(0o755)
+
+    env = dict(os.environ, CONDA_EXE=str(conda))
+    cmd = [sys.executable, '-m', 'nb_conda_kernels', 'list', '--timings', '--json',
+           '--CondaKernelSpecManager.conda_only=True']
+    result = json.loads(subprocess.check_output(cmd, env=env))
+    assert sorted(result['kernelspecs']) == ['conda-env-env1-py', 'conda-env-env2-py']
+    timings = result['timings']
+    assert {'conda_info', 'all_envs', 'all_kernels', 'kernel_specs'} <= set(timings['phases'])
+    scans = timings['env_scans']
+    assert sorted(scan['env_path'] for scan in scans) == sorted(envs + [str(tmp_path)])
+    assert [scan['duration'] for scan in scans] == sorted((scan['duration'] for scan in scans), reverse=True)
+    assert timings['total'] >= timings['phases']['conda_info']
+
+    output = subprocess.check_output(cmd[:-2] + cmd[-1:], env=env).decode()
+    assert 'conda-env-env1-py' in output
+    assert 'Environment scans, slowest first:' in output
+    # The phases run by the refresh are indented under it
+    lines = output.splitlines()
+    refresh = next(i for i, line in enumerate(lines) if line.split() and line.split()[0] == 'refresh')
+    assert lines[refresh].startswith('  refresh ')
+    nested = sorted(line.split()[0] for line in lines[refresh + 1:refresh + 3])
+    assert nested == ['all_envs', 'all_kernels']
+    assert all(line.startswith('    all_') for line in lines[refresh + 1:refresh + 3])
+
 
 if __name__ == '__main__':
     test_configuration()
@@ -0,0 +1,64 @@
+import json
+import sys
+
+import pytest
+
+from nb_conda_kernels.doctor import activate_scripts, profile_env
+
+pytestmark = pytest.mark.skipif(sys.platform.startswith('win'), reason="uses shell scripts")
+
+# A stand-in for conda's activate script, which runs the activate.d scripts
+ACTIVATE = """
+CONDA_PREFIX="$1"
+export CONDA_PREFIX
+for script in "$1"/etc/conda/activate.d/*.sh; do
+    [ -f "$script" ] && . "$script"
+done
+"""
+
+
+@pytest.fixture
+def conda_root(tmp_path):
+    (tmp_path / 'bin').mkdir()
+    (tmp_path / 'bin' / 'activate').write_text(ACTIVATE)
+    return tmp_path
+
+
+def make_env(conda_root, name, scripts):
+    env_path = conda_root / 'envs' / name
+    activate_d = env_path / 'etc' / 'conda' / 'activate.d'
+    activate_d.mkdir(parents=True)
+    for script, content in scripts.items():
+        (activate_d / script).write_text(content)
+    return str(env_path)
+
+
+def test_profile_env(conda_root):
+    env_path = make_env(conda_root, 'env', {
+        'a-fast.sh': 'export FAST=1\n',
+        'b-slow.sh': '# conda is not run here\nsleep 0.5\npython -c pass 2>/dev/null || true\n',
+        'c-ignored.bat': 'rem not for posix\n',
+    })
+    assert [s.rsplit('/', 1)[1] for s in activate_scripts(env_path)] == ['a-fast.sh', 'b-slow.sh']
+
+    report = profile_env(str(conda_root), 'env', env_path, timeout=10, slow_threshold=0.3)
+    assert report['activated'] and report['error'] is None
+    assert report['activation'] >= 0.5
+    slow, fast = report['scripts']
+    assert slow['path'].endswith('b-slow.sh') and fast['path'].endswith('a-fast.sh')
+    assert slow['duration'] >= 0.5 > fast['duration']
+    assert len(slow['suggestions']) == 2
+    assert 'starts an interpreter' in slow['suggestions'][1]
+    assert fast['suggestions'] == []
+    json.dumps(report)
+
+
+def test_profile_env_failures(conda_root):
+    env_path = make_env(conda_root, 'env', {'hang.sh': 'sleep 5\n'})
+    report = profile_env(str(conda_root), 'env', env_path, timeout=0.5, slow_threshold=0.3)
+    assert report['error'] == 'did not finish within 0.5 seconds'
+    assert 'kernels of this environment may not start' in report['suggestions'][0]
+    assert report['scripts'][0]['error'] == 'did not finish within 0.5 seconds'
+
+    report = profile_env(str(conda_root), 'current', sys.prefix, timeout=0.5, slow_threshold=0.3)
+    assert not report['activated'] and report['scripts'] == []
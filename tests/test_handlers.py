@@ -0,0 +1,115 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+pytest.importorskip("jupyter_server")
+
+from jupyter_server.serverapp import ServerApp  # noqa
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError  # noqa
+
+from nb_conda_kernels.handlers import kernelspecs_etag  # noqa
+from nb_conda_kernels.manager import CondaKernelSpecManager  # noqa
+
+TOKEN = "nb_conda_kernels-test"
+
+
+def test_kernelspecs_etag():
+    fingerprints = {"python3": (1, 10), "conda-env-x-py": (2, 20)}
+    etag = kernelspecs_etag(3, {"python3": "/a", "conda-env-x-py": "/b"}, "python3", fingerprints)
+    assert etag.startswith('"3-') and etag.endswith('"')
+    assert etag == kernelspecs_etag(3, {"conda-env-x-py": "/b", "python3": "/a"}, "python3", fingerprints)
+    assert etag != kernelspecs_etag(4, {"python3": "/a", "conda-env-x-py": "/b"}, "python3", fingerprints)
+    assert etag != kernelspecs_etag(3, {"python3": "/a", "conda-env-x-py": "/c"}, "python3", fingerprints)
+    assert etag != kernelspecs_etag(3, {"python3": "/a", "conda-env-x-py": "/b"}, "conda-env-x-py",
+                                    fingerprints)
+    assert etag != kernelspecs_etag(3, {"python3": "/a", "conda-env-x-py": "/b"}, "python3",
+                                    dict(fingerprints, python3=(1, 11)))
+
+
+def test_kernelspecs_api(monkeypatch, tmp_path):
+    for name in ("config", "data", "runtime"):
+        (tmp_path / name).mkdir()
+        monkeypatch.setenv("JUPYTER_{}_DIR".format(name.upper()), str(tmp_path / name))
+    envs = {}
+
+    def add_env(name, python='python'):
+        kernel_dir = tmp_path / name / 'share' / 'jupyter' / 'kernels' / 'python3'
+        kernel_dir.mkdir(parents=True, exist_ok=True)
+        (kernel_dir / 'kernel.json').write_text(json.dumps(
+            {'argv': [python], 'display_name': 'Python 3', 'language': 'python'}))
+        envs[name] = str(tmp_path / name)
+
+    monkeypatch.setattr(CondaKernelSpecManager, "_conda_info", {'conda_prefix': '/', 'envs': []})
+    monkeypatch.setattr(CondaKernelSpecManager, "_all_envs", lambda self: dict(envs))
+    add_env('env1')
+
+    async def run():
+        app = ServerApp(
+            kernel_spec_manager_class=CondaKernelSpecManager,
+            jpserver_extensions={"nb_conda_kernels": True},
+            open_browser=False,
+            port=0,
+            root_dir=str(tmp_path),
+        )
+        app.initialize(argv=["--IdentityProvider.token={}".format(TOKEN),
+                             "--CondaKernelSpecManager.conda_only=True"])
+        url = "http://127.0.0.1:{}/api/conda/kernelspecs".format(app.port)
+        ksm = app.kernel_spec_manager
+        # The kernels must never be refreshed on the event loop
+        refresh_threads = []
+        refresh_snapshot = CondaKernelSpecManager._refresh_snapshot
+
+        def record_refresh(self, *args):
+            refresh_threads.append(threading.current_thread())
+            return refresh_snapshot(self, *args)
+
+        monkeypatch.setattr(CondaKernelSpecManager, "_refresh_snapshot", record_refresh)
+        headers = {"Authorization": "token {}".format(TOKEN)}
+        client = AsyncHTTPClient()
+        try:
+            response = await client.fetch(url, headers=headers)
+            model = json.loads(response.body)
+            assert list(model["kernelspecs"]) == ["conda-env-env1-py"]
+            spec = model["kernelspecs"]["conda-env-env1-py"]["spec"]
+            assert spec["display_name"] == "Python [conda env:env1]"
+            etag = response.headers["ETag"]
+
+            with pytest.raises(HTTPClientError) as err:
+                await client.fetch(url, headers=dict(headers, **{"If-None-Match": etag}))
+            assert err.value.code == 304
+
+            add_env('env2')
+            ksm._snapshot = ksm._snapshot._replace(expiry=0)
+            with pytest.raises(HTTPClientError) as err:
+                await client.fetch(url, method="POST", body=b"")
+            assert err.value.code == 403
+            response = await client.fetch(url, method="POST", body=b"", headers=headers)
+            assert response.code == 202
+            for _ in range(100):
+                if ksm._snapshot.generation == 2:
+                    break
+                await asyncio.sleep(0.05)
+
+            response = await client.fetch(url, headers=dict(headers, **{"If-None-Match": etag}))
+            assert response.headers["ETag"] != etag
+            assert sorted(json.loads(response.body)["kernelspecs"]) == [
+                "conda-env-env1-py", "conda-env-env2-py"]
+            etag = response.headers["ETag"]
+
+            # A kernel.json edited in place is served again once refreshed
+            add_env('env1', python='python3.12')
+            ksm._snapshot = ksm._snapshot._replace(expiry=0)
+            response = await client.fetch(url, headers=dict(headers, **{"If-None-Match": etag}))
+            assert response.headers["ETag"] != etag
+            spec = json.loads(response.body)["kernelspecs"]["conda-env-env1-py"]["spec"]
+            assert spec["argv"][-1] == "python3.12"
+            assert ksm._snapshot.generation == 2
+            assert refresh_threads and threading.main_thread() not in refresh_threads
+        finally:
+            client.close()
+            app.http_server.stop()
+            await app.kernel_manager.shutdown_all()
+
+    asyncio.run(run())